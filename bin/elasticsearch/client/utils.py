@@ -69,8 +69,8 @@ def query_params(*es_query_params):
                     if v is not None:
                         params[p] = _escape(v)
 
-            # don't treat ignore and request_timeout as other params to avoid escaping
-            for p in ('ignore', 'request_timeout'):
+            # don't treat ignore, request_timeout and stream as other params to avoid escaping
+            for p in ('ignore', 'request_timeout', 'stream'):
                 if p in kwargs:
                     params[p] = kwargs.pop(p)
             return func(*args, params=params, **kwargs)
@@ -1,4 +1,5 @@
 import logging
+import threading
 try:
     import simplejson as json
 except ImportError:
@@ -43,6 +44,32 @@ class Connection(object):
         self.url_prefix = url_prefix
         self.timeout = timeout
 
+        # request timings, used by latency aware selectors
+        self.latency = None
+        self.in_flight = 0
+        self._stats_lock = threading.Lock()
+
+    # weight of the latest request in the latency moving average
+    latency_decay = 0.3
+
+    def request_started(self):
+        """ Count a request sent over this connection as in flight. """
+        with self._stats_lock:
+            self.in_flight += 1
+
+    def request_finished(self, duration):
+        """
+        Count a request as done and fold its duration (in seconds, failed
+        requests included) into the exponentially weighted moving average
+        latency of this connection.
+        """
+        with self._stats_lock:
+            self.in_flight -= 1
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += self.latency_decay * (duration - self.latency)
+
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.host)
 
@@ -1,5 +1,6 @@
 import time
 import ssl
+import zlib
 import urllib3
 from urllib3.exceptions import ReadTimeoutError, SSLError as UrllibSSLError
 import warnings
@@ -15,6 +16,7 @@ except ImportError:
 from .base import Connection
 from ..exceptions import ConnectionError, ImproperlyConfigured, ConnectionTimeout, SSLError
 from ..compat import urlencode
+from ..stream import StreamedResponse
 
 
 def create_ssl_context(**kwargs):
@@ -57,11 +59,18 @@ class Urllib3HttpConnection(Connection):
         host. See https://urllib3.readthedocs.io/en/1.4/pools.html#api for more
         information.
     :arg headers: any custom http headers to be add to requests
+    :arg http_compress: ask for gzip compressed responses (decoded
+        transparently, streamed ones included) and gzip request bodies of at
+        least ``http_compress_min_bytes``
+    :arg http_compress_min_bytes: size from which request bodies are
+        compressed when ``http_compress`` is set, ``None`` never compresses
+        them (default: 64KB)
     """
     def __init__(self, host='localhost', port=9200, http_auth=None,
             use_ssl=False, verify_certs=True, ca_certs=None, client_cert=None,
             client_key=None, ssl_version=None, ssl_assert_hostname=None,
-            ssl_assert_fingerprint=None, maxsize=10, headers=None, ssl_context=None, **kwargs):
+            ssl_assert_fingerprint=None, maxsize=10, headers=None, ssl_context=None,
+            http_compress=False, http_compress_min_bytes=64 * 1024, **kwargs):
 
         super(Urllib3HttpConnection, self).__init__(host=host, port=port, use_ssl=use_ssl, **kwargs)
         self.headers = urllib3.make_headers(keep_alive=True)
@@ -76,6 +85,11 @@ class Urllib3HttpConnection(Connection):
                 self.headers[k.lower()] = headers[k]
 
         self.headers.setdefault('content-type', 'application/json')
+
+        self.http_compress = http_compress
+        self.http_compress_min_bytes = http_compress_min_bytes
+        if http_compress:
+            self.headers['accept-encoding'] = 'gzip'
         pool_class = urllib3.HTTPConnectionPool
         kw = {}
 
@@ -121,13 +135,14 @@ class Urllib3HttpConnection(Connection):
             })
         self.pool = pool_class(host, port=port, timeout=self.timeout, maxsize=maxsize, **kw)
 
-    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None, stream=False):
         url = self.url_prefix + url
         if params:
             url = '%s?%s' % (url, urlencode(params))
         full_url = self.host + url
 
         start = time.time()
+        self.request_started()
         try:
             kw = {}
             if timeout:
@@ -141,13 +156,25 @@ class Urllib3HttpConnection(Connection):
             if not isinstance(method, str):
                 method = method.encode('utf-8')
 
+            request_headers = self.headers
             if headers:
                 request_headers = dict(self.headers)
-                request_headers.update(headers or {})
-            response = self.pool.urlopen(method, url, body, retries=False, headers=self.headers, **kw)
+                request_headers.update(headers)
+
+            request_body = body
+            if body and self._compress_body(body):
+                request_body = self._gzip(body)
+                request_headers = dict(request_headers)
+                request_headers['content-encoding'] = 'gzip'
+
+            response = self.pool.urlopen(method, url, request_body, retries=False, headers=request_headers, preload_content=not stream, **kw)
             duration = time.time() - start
-            raw_data = response.data.decode('utf-8')
+            if stream and 200 <= response.status < 300:
+                raw_data = None
+            else:
+                raw_data = response.data.decode('utf-8')
         except Exception as e:
+            self.request_finished(time.time() - start)
             self.log_request_fail(method, full_url, url, body, time.time() - start, exception=e)
             if isinstance(e, UrllibSSLError):
                 raise SSLError('N/A', str(e), e)
@@ -155,6 +182,8 @@ class Urllib3HttpConnection(Connection):
                 raise ConnectionTimeout('TIMEOUT', str(e), e)
             raise ConnectionError('N/A', str(e), e)
 
+        self.request_finished(duration)
+
         # raise errors based on http status codes, let the client handle those if needed
         if not (200 <= response.status < 300) and response.status not in ignore:
             self.log_request_fail(method, full_url, url, body, duration, response.status, raw_data)
@@ -163,8 +192,41 @@ class Urllib3HttpConnection(Connection):
         self.log_request_success(method, full_url, url, body, response.status,
             raw_data, duration)
 
+        if raw_data is None:
+            return response.status, response.getheaders(), StreamedResponse(
+                self._read_chunks(response), lambda done: self._release(response, done),
+                response.getheaders())
         return response.status, response.getheaders(), raw_data
 
+    def _compress_body(self, body):
+        return self.http_compress and self.http_compress_min_bytes is not None \
+            and len(body) >= self.http_compress_min_bytes
+
+    def _gzip(self, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        # wbits offset by 16 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def _read_chunks(self, response, chunk_size=64 * 1024):
+        try:
+            for chunk in response.stream(chunk_size):
+                yield chunk
+        except ReadTimeoutError as e:
+            raise ConnectionTimeout('TIMEOUT', str(e), e)
+        except Exception as e:
+            if isinstance(e, UrllibSSLError):
+                raise SSLError('N/A', str(e), e)
+            raise ConnectionError('N/A', str(e), e)
+
+    def _release(self, response, done):
+        # a partially read body can't be reused, drop the socket instead of
+        # handing it back to the pool with data pending on it
+        if not done:
+            response.close()
+        response.release_conn()
+
     def close(self):
         """
         Explicitly closes connection
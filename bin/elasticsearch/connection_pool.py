@@ -1,7 +1,9 @@
+import os
 import time
 import random
 import logging
 import threading
+import weakref
 
 try:
     from Queue import PriorityQueue, Empty
@@ -9,6 +11,8 @@ except ImportError:
     from queue import PriorityQueue, Empty
 
 from .exceptions import ImproperlyConfigured
+from .state import StateFile
+from .compat import string_types
 
 logger = logging.getLogger('elasticsearch')
 
@@ -66,6 +70,41 @@ class RoundRobinSelector(ConnectionSelector):
         self.data.rr %= len(connections)
         return connections[self.data.rr]
 
+class AdaptiveSelector(ConnectionSelector):
+    """
+    Latency aware selector: picks the connection with the lowest expected
+    wait, its moving average latency times the number of requests in flight
+    on it plus one, so a node that is alive but slow (GC pauses, hot shards)
+    gets fewer requests for as long as it stays slow. Connections without
+    any measurement yet are tried first.
+
+    Every ``explore`` of the selections (default 5%) is made at random
+    instead, so a node that has recovered gets measured again.
+    """
+    explore = 0.05
+
+    def select(self, connections):
+        if random.random() < self.explore:
+            return random.choice(connections)
+
+        best, best_score = [], None
+        for connection in connections:
+            latency = getattr(connection, 'latency', None)
+            score = 0 if latency is None else latency * (connection.in_flight + 1)
+            if best_score is None or score < best_score:
+                best, best_score = [connection], score
+            elif score == best_score:
+                best.append(connection)
+        return random.choice(best)
+
+
+# selectors that can be given by name, eg. from a configuration file
+SELECTORS = {
+    'round_robin': RoundRobinSelector,
+    'random': RandomSelector,
+    'adaptive': AdaptiveSelector,
+}
+
 class ConnectionPool(object):
     """
     Container holding the :class:`~elasticsearch.Connection` instances,
@@ -87,9 +126,23 @@ class ConnectionPool(object):
     the timeout is over the connection will be resurrected and returned to the
     live pool. A connection that has been previously marked as dead and
     succeeds will be marked as live (its fail count will be deleted).
+
+    With a ``dead_state_path`` the dead connections, their fail counts and
+    timeouts are shared with every pool using the same file, in this or other
+    processes: a node that failed for one of them is retired for all, without
+    each paying a connection timeout to find out.
+
+    With ``health_check`` dead connections are not resurrected by
+    `get_connection` anymore but probed with a ``HEAD /`` request from a
+    background thread once their timeout is over, and only returned to the
+    live pool when the probe succeeds. A failed probe counts as another
+    failure. Requests then never wait on a node that is still down, unless
+    there is no live connection left.
     """
     def __init__(self, connections, dead_timeout=60, timeout_cutoff=5,
-        selector_class=RoundRobinSelector, randomize_hosts=True, **kwargs):
+        selector_class=RoundRobinSelector, randomize_hosts=True,
+        dead_state_path=None, health_check=False, health_check_timeout=None,
+        **kwargs):
         """
         :arg connections: list of tuples containing the
             :class:`~elasticsearch.Connection` instance and it's options
@@ -98,9 +151,17 @@ class ConnectionPool(object):
         :arg timeout_cutoff: number of consecutive failures after which the
             timeout doesn't increase
         :arg selector_class: :class:`~elasticsearch.ConnectionSelector`
-            subclass to use if more than one connection is live
+            subclass to use if more than one connection is live, or the name
+            of one of the bundled selectors (``'round_robin'``, ``'random'``
+            or ``'adaptive'``)
         :arg randomize_hosts: shuffle the list of connections upon arrival to
             avoid dog piling effect across processes
+        :arg dead_state_path: path of a file sharing the dead connections
+            between pools, connections are identified by their url
+        :arg health_check: probe dead connections from a background thread
+            instead of resurrecting them from `get_connection`
+        :arg health_check_timeout: timeout of the probes, the connection's
+            default timeout if not set
         """
         if not connections:
             raise ImproperlyConfigured("No defined connections, you need to "
@@ -122,8 +183,68 @@ class ConnectionPool(object):
         self.dead_timeout = dead_timeout
         self.timeout_cutoff = timeout_cutoff
 
+        if isinstance(selector_class, string_types):
+            if selector_class not in SELECTORS:
+                raise ImproperlyConfigured("Unknown connection selector %r, expected one "
+                        "of %s." % (selector_class, ', '.join(sorted(SELECTORS))))
+            selector_class = SELECTORS[selector_class]
         self.selector = selector_class(dict(connections))
 
+        # dead connections shared through a file, re-read when it changes
+        self.dead_state = StateFile(dead_state_path) if dead_state_path else None
+        self._dead_state_mtime = None
+        self._dead_state_keys = set()
+        # background resurrection of the dead connections, the thread runs
+        # only while there are some
+        self.health_check = health_check
+        self.health_check_timeout = health_check_timeout
+        self._health_lock = threading.Lock()
+        self._health_thread = None
+        self._health_stop = threading.Event()
+
+        if self.dead_state is not None:
+            self._sync_dead_state()
+
+    def _state_key(self, connection):
+        return connection.host + connection.url_prefix
+
+    def _sync_dead_state(self, now=None):
+        """
+        Retire the live connections marked as dead in ``dead_state`` since it
+        was last read. With ``health_check`` those whose timeout already
+        expired are retired too, to be probed before they get requests again.
+        """
+        try:
+            mtime = os.stat(self.dead_state.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._dead_state_mtime:
+            return
+        self._dead_state_mtime = mtime
+
+        now = now if now else time.time()
+        dead = self.dead_state.read()
+        self._dead_state_keys = set(dead)
+        for connection in self.connections[:]:
+            entry = dead.get(self._state_key(connection))
+            if not entry or (entry['until'] <= now and not self.health_check):
+                continue
+            try:
+                self.connections.remove(connection)
+            except ValueError:
+                # another thread retired it already
+                continue
+            self.dead_count[connection] = entry['count']
+            self.dead.put((entry['until'], connection))
+            if entry['until'] > now:
+                logger.warning(
+                    'Connection %r has failed for %i times in a row in another process, putting on %i second timeout.',
+                    connection, entry['count'], entry['until'] - now
+                )
+            else:
+                logger.info('Connection %r has failed in another process, probing it before use.', connection)
+            self._start_health_check()
+
     def mark_dead(self, connection, now=None):
         """
         Mark the connection as dead (failed). Remove it from the live pool and
@@ -139,14 +260,43 @@ class ConnectionPool(object):
             # connection not alive or another thread marked it already, ignore
             return
         else:
-            dead_count = self.dead_count.get(connection, 0) + 1
-            self.dead_count[connection] = dead_count
+            self._retire(connection, now)
+
+    def _retire(self, connection, now):
+        """
+        Put a connection that is not live on a timeout, increasing with its
+        consecutive failures.
+        """
+        dead_count = self.dead_count.get(connection, 0) + 1
+        timeout = self.dead_timeout * 2 ** min(dead_count - 1, self.timeout_cutoff)
+        if self.dead_state is not None:
+            dead_count, timeout = self._share_dead(connection, dead_count, now)
+        self.dead_count[connection] = dead_count
+        self.dead.put((now + timeout, connection))
+        logger.warning(
+            'Connection %r has failed for %i times in a row, putting on %i second timeout.',
+            connection, dead_count, timeout
+        )
+        self._start_health_check()
+
+    def _share_dead(self, connection, dead_count, now):
+        """
+        Record a failed connection in ``dead_state``, returns its fail count
+        and timeout which are those of another process that retired it
+        already, if any.
+        """
+        key = self._state_key(connection)
+        with self.dead_state.update() as dead:
+            entry = dead.get(key)
+            if entry and entry['until'] > now:
+                return entry['count'], entry['until'] - now
+            if entry:
+                # failed again since it was last resurrected
+                dead_count = max(dead_count, entry['count'] + 1)
             timeout = self.dead_timeout * 2 ** min(dead_count - 1, self.timeout_cutoff)
-            self.dead.put((now + timeout, connection))
-            logger.warning(
-                'Connection %r has failed for %i times in a row, putting on %i second timeout.',
-                connection, dead_count, timeout
-            )
+            dead[key] = {'count': dead_count, 'until': now + timeout}
+        self._dead_state_keys.add(key)
+        return dead_count, timeout
 
     def mark_live(self, connection):
         """
@@ -161,6 +311,13 @@ class ConnectionPool(object):
             # race condition, safe to ignore
             pass
 
+        # only touch the shared state for connections recorded there
+        key = self._state_key(connection)
+        if self.dead_state is not None and key in self._dead_state_keys:
+            self._dead_state_keys.discard(key)
+            with self.dead_state.update() as dead:
+                dead.pop(key, None)
+
     def resurrect(self, force=False):
         """
         Attempt to resurrect a connection from the dead pool. It will try to
@@ -198,23 +355,85 @@ class ConnectionPool(object):
             self.dead.put((timeout, connection))
             return
 
+        if not force and self.dead_state is not None:
+            entry = self.dead_state.read().get(self._state_key(connection))
+            if entry and entry['until'] > time.time():
+                # failed again in another process meanwhile, wait for it
+                self.dead_count[connection] = entry['count']
+                self.dead.put((entry['until'], connection))
+                return
+
         # either we were forced or the connection is elligible to be retried
         self.connections.append(connection)
         logger.info('Resurrecting connection %r (force=%s).', connection, force)
         return connection
 
+    def _start_health_check(self):
+        if not self.health_check:
+            return
+        with self._health_lock:
+            if self._health_thread is None and not self._health_stop.is_set():
+                # the thread doesn't keep a discarded pool, eg. after sniffing, alive
+                self._health_thread = threading.Thread(target=_health_check, args=(weakref.ref(self), ))
+                self._health_thread.daemon = True
+                self._health_thread.start()
+
+    def _next_probe(self):
+        """
+        Take the next dead connection to probe from the dead pool, returns
+        ``(None, delay)`` when none is eligible for ``delay`` seconds and
+        ``(None, None)`` when there are no dead connections left, in which
+        case the health check thread must exit.
+        """
+        with self._health_lock:
+            try:
+                timeout, connection = self.dead.get(block=False)
+            except Empty:
+                self._health_thread = None
+                return None, None
+
+        now = time.time()
+        if timeout <= now and self.dead_state is not None:
+            entry = self.dead_state.read().get(self._state_key(connection))
+            if entry and entry['until'] > now:
+                # failed again in another process meanwhile, wait for it
+                self.dead_count[connection] = entry['count']
+                timeout = entry['until']
+
+        if timeout > now:
+            self.dead.put((timeout, connection))
+            return None, timeout - now
+        return connection, 0
+
+    def probe(self, connection):
+        """
+        Check whether a dead connection is back with a ``HEAD /`` request.
+
+        :arg connection: the connection to check
+        """
+        try:
+            connection.perform_request('HEAD', '/', timeout=self.health_check_timeout)
+        except Exception as e:
+            logger.info('Health check of connection %r failed: %r.', connection, e)
+            return False
+        return True
+
     def get_connection(self):
         """
         Return a connection from the pool using the `ConnectionSelector`
         instance.
 
-        It tries to resurrect eligible connections, forces a resurrection when
-        no connections are availible and passes the list of live connections to
-        the selector instance to choose from.
+        It tries to resurrect eligible connections (unless they are health
+        checked), forces a resurrection when no connections are availible and
+        passes the list of live connections to the selector instance to choose
+        from.
 
         Returns a connection instance and it's current fail count.
         """
-        self.resurrect()
+        if self.dead_state is not None:
+            self._sync_dead_state()
+        if not self.health_check:
+            self.resurrect()
         connections = self.connections[:]
 
         # no live nodes, resurrect one by force and return it
@@ -232,9 +451,39 @@ class ConnectionPool(object):
         """
         Explicitly closes connections
         """
+        self._health_stop.set()
         for conn in self.orig_connections:
             conn.close()
 
+def _health_check(pool_ref, interval=1):
+    """
+    Health check thread of a :class:`ConnectionPool`, probing its dead
+    connections as their timeouts expire until there are none left, the pool
+    is closed or it isn't used anymore.
+    """
+    while True:
+        pool = pool_ref()
+        if pool is None or pool._health_stop.is_set():
+            return
+        connection, delay = pool._next_probe()
+        if connection is None:
+            if delay is None:
+                return
+            # check the pool often enough to notice new dead connections
+            # with an earlier timeout, or that it was discarded
+            stop, pool = pool._health_stop, None
+            stop.wait(min(delay, interval))
+            continue
+
+        if pool.probe(connection):
+            pool.connections.append(connection)
+            logger.info('Resurrecting connection %r after a successful health check.', connection)
+            pool.mark_live(connection)
+        else:
+            pool._retire(connection, time.time())
+        pool = None
+
+
 class DummyConnectionPool(ConnectionPool):
     def __init__(self, connections, **kwargs):
         if len(connections) != 1:
@@ -2,10 +2,11 @@ from __future__ import unicode_literals
 
 import logging
 from operator import methodcaller
+import threading
 import time
 
-from ..exceptions import ElasticsearchException, TransportError
-from ..compat import map, string_types, Queue
+from ..exceptions import ElasticsearchException, TransportError, ConnectionError
+from ..compat import map, string_types, Queue, Full
 
 
 logger = logging.getLogger('elasticsearch.helpers')
@@ -312,9 +313,116 @@ def parallel_bulk(client, actions, thread_count=4, chunk_size=500,
         pool.close()
         pool.join()
 
+def _scroll_pages(client, query, scroll, raise_on_error, preserve_order, size,
+                  request_timeout, clear_scroll, scroll_kwargs, **kwargs):
+    """
+    Iterate over the raw responses of a scroll, clearing it when done.
+    """
+    scroll_kwargs = scroll_kwargs or {}
+
+    if not preserve_order:
+        query = query.copy() if query else {}
+        query["sort"] = "_doc"
+    # initial search
+    resp = client.search(body=query, scroll=scroll, size=size,
+                         request_timeout=request_timeout, **kwargs)
+
+    scroll_id = resp.get('_scroll_id')
+    if scroll_id is None:
+        return
+
+    try:
+        first_run = True
+        while True:
+            # if we didn't set search_type to scan initial search contains data
+            if first_run:
+                first_run = False
+            else:
+                resp = client.scroll(scroll_id, scroll=scroll,
+                                     request_timeout=request_timeout,
+                                     **scroll_kwargs)
+
+            yield resp
+
+            # check if we have any errrors
+            if resp["_shards"]["successful"] < resp["_shards"]["total"]:
+                logger.warning(
+                    'Scroll request has only succeeded on %d shards out of %d.',
+                    resp['_shards']['successful'], resp['_shards']['total']
+                )
+                if raise_on_error:
+                    raise ScanError(
+                        scroll_id,
+                        'Scroll request has only succeeded on %d shards out of %d.' %
+                            (resp['_shards']['successful'], resp['_shards']['total'])
+                    )
+
+            scroll_id = resp.get('_scroll_id')
+            # end of scroll
+            if scroll_id is None or not resp['hits']['hits']:
+                break
+    finally:
+        if scroll_id and clear_scroll:
+            client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
+
+def _streamed_scroll_hits(client, query, scroll, raise_on_error, preserve_order,
+                          size, request_timeout, clear_scroll, scroll_kwargs,
+                          **kwargs):
+    """
+    Like :func:`_scroll_pages` but every page is requested with
+    ``stream=True`` and its hits are yielded as they are decoded from the
+    response body, so no page is ever held in memory as a whole.
+    """
+    scroll_kwargs = scroll_kwargs or {}
+
+    if not preserve_order:
+        query = query.copy() if query else {}
+        query["sort"] = "_doc"
+    # initial search
+    resp = client.search(body=query, scroll=scroll, size=size,
+                         request_timeout=request_timeout, stream=True, **kwargs)
+
+    scroll_id = None
+    try:
+        while True:
+            count = 0
+            with resp:
+                for hit in resp:
+                    # the scroll id precedes the hits in the body
+                    scroll_id = resp.meta.get('_scroll_id', scroll_id)
+                    count += 1
+                    yield hit
+                resp.consume()
+
+            # check if we have any errrors
+            shards = resp.meta.get('_shards', {})
+            if shards.get('successful', 0) < shards.get('total', 0):
+                logger.warning(
+                    'Scroll request has only succeeded on %d shards out of %d.',
+                    shards['successful'], shards['total']
+                )
+                if raise_on_error:
+                    raise ScanError(
+                        scroll_id,
+                        'Scroll request has only succeeded on %d shards out of %d.' %
+                            (shards['successful'], shards['total'])
+                    )
+
+            scroll_id = resp.meta.get('_scroll_id')
+            # end of scroll
+            if scroll_id is None or not count:
+                break
+
+            resp = client.scroll(scroll_id, scroll=scroll,
+                                 request_timeout=request_timeout, stream=True,
+                                 **scroll_kwargs)
+    finally:
+        if scroll_id and clear_scroll:
+            client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
+
 def scan(client, query=None, scroll='5m', raise_on_error=True,
          preserve_order=False, size=1000, request_timeout=None, clear_scroll=True,
-         scroll_kwargs=None, **kwargs):
+         scroll_kwargs=None, prefetch=0, stream=False, **kwargs):
     """
     Simple abstraction on top of the
     :meth:`~elasticsearch.Elasticsearch.scroll` api - a simple iterator that
@@ -343,6 +451,14 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
         to true.
     :arg scroll_kwargs: additional kwargs to be passed to
         :meth:`~elasticsearch.Elasticsearch.scroll`
+    :arg prefetch: number of pages fetched ahead on a background thread while
+        the hits of the current one are consumed, defaults to 0 (each page
+        is requested only when the previous one has been consumed)
+    :arg stream: decode the hits of every page while its body is being read
+        (see :class:`~elasticsearch.stream.StreamedResponse`) instead of
+        loading the whole page first, so only the hit being decoded is held
+        in memory. ``prefetch`` is ignored, buffering decoded hits ahead of
+        the caller would defeat it
 
     Any additional keyword arguments will be passed to the initial
     :meth:`~elasticsearch.Elasticsearch.search` call::
@@ -354,53 +470,433 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
         )
 
     """
-    scroll_kwargs = scroll_kwargs or {}
-
-    if not preserve_order:
-        query = query.copy() if query else {}
-        query["sort"] = "_doc"
-    # initial search
-    resp = client.search(body=query, scroll=scroll, size=size,
-                         request_timeout=request_timeout, **kwargs)
-
-    scroll_id = resp.get('_scroll_id')
-    if scroll_id is None:
+    if stream:
+        hits = _streamed_scroll_hits(client, query, scroll, raise_on_error,
+                                     preserve_order, size, request_timeout,
+                                     clear_scroll, scroll_kwargs, **kwargs)
+        try:
+            for hit in hits:
+                yield hit
+        finally:
+            hits.close()
         return
 
-    try:
-        first_run = True
-        while True:
-            # if we didn't set search_type to scan initial search contains data
-            if first_run:
-                first_run = False
-            else:
-                resp = client.scroll(scroll_id, scroll=scroll,
-                                     request_timeout=request_timeout,
-                                     **scroll_kwargs)
+    pages = lambda: _scroll_pages(client, query, scroll, raise_on_error,
+                                  preserve_order, size, request_timeout,
+                                  clear_scroll, scroll_kwargs, **kwargs)
+    if prefetch > 0:
+        pages = _fan_in([pages], queue_size=prefetch)
+    else:
+        pages = pages()
 
+    try:
+        for resp in pages:
             for hit in resp['hits']['hits']:
                 yield hit
+    finally:
+        pages.close()
 
-            # check if we have any errrors
-            if resp["_shards"]["successful"] < resp["_shards"]["total"]:
+# Marks the end of one producer's output on the fan-in queue
+_PRODUCER_DONE = object()
+
+# Hits buffered between parallel streamed scans and the caller, streaming
+# exists to keep memory bounded by a few hits instead of pages
+STREAM_QUEUE_SIZE = 16
+
+def _fan_in(producers, thread_count=None, queue_size=1000):
+    """
+    Run each of the given producers (callables returning an iterable) in its
+    own thread and yield their items, in arrival order, as a single iterator.
+
+    Producers put their items on a bounded queue so a slow consumer applies
+    backpressure instead of buffering everything in memory. When the consumer
+    stops early (or a producer fails) the remaining producers are stopped and
+    their iterators closed, so any cleanup in them (e.g. clearing a scroll)
+    runs before this generator returns.
+
+    :arg producers: list of callables, each returning an iterable
+    :arg thread_count: maximum number of producers running at once, defaults
+        to one thread per producer
+    :arg queue_size: maximum number of items buffered between the producers
+        and the consumer
+    """
+    queue = Queue(queue_size)
+    stop = threading.Event()
+    running = threading.BoundedSemaphore(thread_count or len(producers))
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce(producer):
+        with running:
+            items = None
+            try:
+                if stop.is_set():
+                    return
+                items = iter(producer())
+                for item in items:
+                    if not _put((None, item)):
+                        break
+            except Exception as e:
+                _put((e, None))
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+                _put((None, _PRODUCER_DONE))
+
+    threads = [threading.Thread(target=_produce, args=(p, )) for p in producers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        pending = len(threads)
+        while pending:
+            error, item = queue.get()
+            if error is not None:
+                raise error
+            if item is _PRODUCER_DONE:
+                pending -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def sliced_scan(client, query=None, slices=2, thread_count=None,
+                queue_size=1000, **kwargs):
+    """
+    Parallel version of :func:`scan`: opens ``slices`` sliced scrolls over the
+    same query and fetches them concurrently, yielding all hits as a single
+    iterator. Hits from different slices are interleaved in arrival order.
+
+    Every slice clears its own scroll on completion, on error or when the
+    returned iterator is closed before being exhausted.
+
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg query: body for the :meth:`~elasticsearch.Elasticsearch.search` api
+    :arg slices: number of slices to split the scroll into
+    :arg thread_count: maximum number of slices fetched at once, defaults to
+        ``slices``
+    :arg queue_size: maximum number of hits buffered between the fetching
+        threads and the caller, at most ``STREAM_QUEUE_SIZE`` when streaming
+
+    Any additional keyword arguments will be passed to :func:`scan` for each
+    slice.
+    """
+    if slices < 2:
+        return scan(client, query=query, **kwargs)
+    if kwargs.get('stream'):
+        queue_size = min(queue_size, STREAM_QUEUE_SIZE)
+
+    def _slice(slice_id):
+        body = query.copy() if query else {}
+        body['slice'] = {'id': slice_id, 'max': slices}
+        return lambda: scan(client, query=body, **kwargs)
+
+    return _fan_in([_slice(i) for i in range(slices)],
+                   thread_count=thread_count, queue_size=queue_size)
+
+def shard_scan(client, query=None, index=None, doc_type=None, thread_count=None,
+               queue_size=1000, **kwargs):
+    """
+    Parallel version of :func:`scan` with one scroll per shard group. The
+    shard layout of ``index`` is looked up with
+    :meth:`~elasticsearch.Elasticsearch.search_shards`, every shard number
+    becomes a group pinned with the ``preference`` parameter
+    (``_shards:N|_prefer_nodes:...``) to nodes holding a started copy of it,
+    spreading the groups evenly over the nodes. The scrolls are fetched
+    concurrently and their hits yielded as a single iterator.
+
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg query: body for the :meth:`~elasticsearch.Elasticsearch.search` api
+    :arg index: index (or comma separated list/pattern) to scan
+    :arg doc_type: document type(s) to restrict the scan to
+    :arg thread_count: maximum number of shard groups fetched at once,
+        defaults to one thread per group
+    :arg queue_size: maximum number of hits buffered between the fetching
+        threads and the caller, at most ``STREAM_QUEUE_SIZE`` when streaming
+
+    Any additional keyword arguments will be passed to :func:`scan` for each
+    shard group.
+    """
+    layout = client.search_shards(index=index, doc_type=doc_type)
+
+    # shard number -> nodes holding a started copy, per index
+    groups = {}
+    for copies in layout['shards']:
+        started = [c for c in copies if c.get('state') == 'STARTED' and c.get('node')]
+        if started:
+            groups.setdefault(started[0]['shard'], []).append([c['node'] for c in started])
+
+    if len(groups) < 2:
+        return scan(client, query=query, index=index, doc_type=doc_type, **kwargs)
+    if kwargs.get('stream'):
+        queue_size = min(queue_size, STREAM_QUEUE_SIZE)
+
+    # pick the least loaded node among the copies of every shard
+    load = dict((node, 0) for node in layout.get('nodes', {}))
+    def _preference(shard):
+        nodes = set()
+        for candidates in groups[shard]:
+            node = min(candidates, key=lambda n: load.get(n, 0))
+            load[node] = load.get(node, 0) + 1
+            nodes.add(node)
+        return '_shards:%d|_prefer_nodes:%s' % (shard, ','.join(sorted(nodes)))
+
+    def _group(preference):
+        return lambda: scan(client, query=query, index=index, doc_type=doc_type,
+                            preference=preference, **kwargs)
+
+    return _fan_in([_group(_preference(shard)) for shard in sorted(groups)],
+                   thread_count=thread_count, queue_size=queue_size)
+
+def _search_after_pages(client, query, size, max_retries, raise_on_error,
+                        **kwargs):
+    """
+    Page through a sorted search with ``search_after``, yielding the raw
+    response of every non empty page. A page that fails with a connection
+    error or a retryable status is requested again with the same sort values,
+    no server side state has to be recovered.
+    """
+    body = query.copy()
+    body['size'] = size
+    while True:
+        for attempt in range(max_retries + 1):
+            try:
+                resp = client.search(body=body, **kwargs)
+                break
+            except TransportError as e:
+                retry = isinstance(e, ConnectionError) or \
+                    e.status_code in (429, 502, 503, 504)
+                if not retry or attempt == max_retries:
+                    raise
                 logger.warning(
-                    'Scroll request has only succeeded on %d shards out of %d.',
-                    resp['_shards']['successful'], resp['_shards']['total']
+                    'search_after page failed (%s), retrying %d of %d.',
+                    e, attempt + 1, max_retries)
+                time.sleep(min(2 ** attempt, 30))
+
+        if resp['_shards']['successful'] < resp['_shards']['total']:
+            logger.warning(
+                'search_after request has only succeeded on %d shards out of %d.',
+                resp['_shards']['successful'], resp['_shards']['total']
+            )
+            if raise_on_error:
+                raise ScanError(
+                    None,
+                    'search_after request has only succeeded on %d shards out of %d.' %
+                        (resp['_shards']['successful'], resp['_shards']['total'])
                 )
-                if raise_on_error:
-                    raise ScanError(
-                        scroll_id,
-                        'Scroll request has only succeeded on %d shards out of %d.' %
-                            (resp['_shards']['successful'], resp['_shards']['total'])
-                    )
 
-            scroll_id = resp.get('_scroll_id')
-            # end of scroll
-            if scroll_id is None or not resp['hits']['hits']:
-                break
+        hits = resp['hits']['hits']
+        if hits:
+            yield resp
+        if len(hits) < size:
+            return
+        body['search_after'] = hits[-1]['sort']
+
+def search_after_scan(client, query=None, sort=None, size=1000, prefetch=1,
+                      max_retries=3, raise_on_error=True, **kwargs):
+    """
+    Alternative to :func:`scan` that pages with ``search_after`` instead of a
+    scroll. No search context is kept open on the cluster, so it is not
+    limited by ``search.max_open_scroll_context`` and it resumes from the last
+    returned sort values after a transport failure.
+
+    The sort must be total (end with a unique tiebreaker such as ``_id``) for
+    the pagination to be exact. While the hits of a page are being consumed
+    the next ``prefetch`` pages are requested on a background thread.
+
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg query: body for the :meth:`~elasticsearch.Elasticsearch.search` api
+    :arg sort: sort definition to page on, defaults to the one in ``query``
+    :arg size: number of hits requested per page
+    :arg prefetch: number of pages fetched ahead of the caller, ``0`` fetches
+        each page only when the previous one has been consumed
+    :arg max_retries: number of times a failed page is requested again
+    :arg raise_on_error: raises an exception (``ScanError``) if an error is
+        encountered (some shards fail to execute). By default we raise.
+
+    Any additional keyword arguments will be passed to every
+    :meth:`~elasticsearch.Elasticsearch.search` call.
+    """
+    query = query.copy() if query else {}
+    if sort is not None:
+        query['sort'] = sort
+    if not query.get('sort'):
+        raise ValueError('search_after_scan requires a sort definition.')
+
+    pages = lambda: _search_after_pages(client, query, size, max_retries,
+                                        raise_on_error, **kwargs)
+    if prefetch > 0:
+        pages = _fan_in([pages], queue_size=prefetch)
+    else:
+        pages = pages()
+
+    try:
+        for resp in pages:
+            for hit in resp['hits']['hits']:
+                yield hit
     finally:
-        if scroll_id and clear_scroll:
-            client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
+        pages.close()
+
+def _ordered_fan_in(producers, thread_count=None, queue_size=1000):
+    """
+    Like :func:`_fan_in` but yields the items of the producers in producer
+    order: all items of the first producer, then all items of the second and
+    so on, while later producers are already fetching into their own bounded
+    buffers.
+
+    At most ``thread_count`` producers run at once, a new one is started every
+    time the consumer finishes reading one, so the producer being read is
+    always running and buffers never deadlock.
+    """
+    thread_count = thread_count or len(producers)
+    stop = threading.Event()
+    queues = [Queue(queue_size) for _ in producers]
+
+    def _produce(producer, queue):
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        items = None
+        try:
+            items = iter(producer())
+            for item in items:
+                if not _put((None, item)):
+                    break
+        except Exception as e:
+            _put((e, None))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+            _put((None, _PRODUCER_DONE))
+
+    threads = []
+
+    def _start(i):
+        if i < len(producers):
+            thread = threading.Thread(target=_produce, args=(producers[i], queues[i]))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+    for i in range(thread_count):
+        _start(i)
+
+    try:
+        for i, queue in enumerate(queues):
+            while True:
+                error, item = queue.get()
+                if error is not None:
+                    raise error
+                if item is _PRODUCER_DONE:
+                    break
+                yield item
+            _start(i + thread_count)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def ordered_search_after_scan(client, queries, thread_count=None,
+                              buffer_size=1000, **kwargs):
+    """
+    Run one :func:`search_after_scan` per query concurrently and yield their
+    hits one query after the other, in the order the queries were given.
+
+    Meant for queries partitioning a sorted result set (e.g. consecutive time
+    windows): the concatenation is then in global sort order, while every
+    partition but the one being read is fetched ahead into a buffer of at
+    most ``buffer_size`` hits.
+
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg queries: list of bodies for the
+        :meth:`~elasticsearch.Elasticsearch.search` api
+    :arg thread_count: maximum number of queries fetched at once, defaults to
+        one thread per query
+    :arg buffer_size: maximum number of hits buffered per query
+
+    Any additional keyword arguments will be passed to
+    :func:`search_after_scan` for each query.
+    """
+    def _query(query):
+        return lambda: search_after_scan(client, query=query, **kwargs)
+
+    return _ordered_fan_in([_query(q) for q in queries],
+                           thread_count=thread_count, queue_size=buffer_size)
+
+def _composite_pages(client, query, name, **kwargs):
+    """
+    Page through a composite aggregation, yielding the buckets of every page.
+    """
+    body = query.copy()
+    body['size'] = 0
+    body['aggs'] = dict(body['aggs'])
+    body['aggs'][name] = dict(body['aggs'][name])
+    composite = body['aggs'][name]['composite'] = dict(body['aggs'][name]['composite'])
+
+    while True:
+        resp = client.search(body=body, **kwargs)
+        result = resp.get('aggregations', {}).get(name, {})
+        buckets = result.get('buckets', [])
+        if buckets:
+            yield buckets
+        if len(buckets) < composite['size']:
+            return
+        # after_key is only returned from 6.3 on
+        composite['after'] = result.get('after_key', buckets[-1]['key'])
+
+def composite_scan(client, query=None, sources=None, aggs=None, size=1000,
+                   prefetch=1, **kwargs):
+    """
+    Simple iterator over all the buckets of a ``composite`` aggregation, paged
+    with its ``after`` key, so group-bys of any cardinality can be streamed
+    instead of being returned by one huge response.
+
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg query: body for the :meth:`~elasticsearch.Elasticsearch.search` api,
+        any aggregations in it are replaced
+    :arg sources: list of the composite aggregation ``sources``
+    :arg aggs: sub aggregations computed for every bucket
+    :arg size: number of buckets requested per page
+    :arg prefetch: number of pages fetched ahead on a background thread, ``0``
+        fetches each page only when the previous one has been consumed
+
+    Any additional keyword arguments will be passed to every
+    :meth:`~elasticsearch.Elasticsearch.search` call.
+    """
+    composite = {'composite': {'sources': sources, 'size': size}}
+    if aggs:
+        composite['aggs'] = aggs
+    query = query.copy() if query else {}
+    query['aggs'] = {'composite': composite}
+
+    pages = lambda: _composite_pages(client, query, 'composite', **kwargs)
+    if prefetch > 0:
+        pages = _fan_in([pages], queue_size=prefetch)
+    else:
+        pages = pages()
+
+    try:
+        for buckets in pages:
+            for bucket in buckets:
+                yield bucket
+    finally:
+        pages.close()
 
 def reindex(client, source_index, target_index, query=None, target_client=None,
         chunk_size=500, scroll='5m', scan_kwargs={}, bulk_kwargs={}):
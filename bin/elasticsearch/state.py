@@ -0,0 +1,86 @@
+import os
+import json
+import logging
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks, updates from concurrent processes may be lost
+    fcntl = None
+
+logger = logging.getLogger('elasticsearch')
+
+
+class StateFile(object):
+    """
+    Small JSON document kept in a file and shared by all the processes using
+    the same path, eg. the sniffed nodes of a cluster. Reads don't lock since
+    the file is always replaced atomically, updates are serialized by an
+    exclusive ``fcntl`` lock on a ``.lock`` file next to it.
+
+    State is an optimization: a missing, unreadable or corrupt file reads as
+    an empty document and failed writes are only logged.
+
+    :arg path: path of the state file, its directory is created as needed
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """
+        Return the document stored, an empty dict when there is none.
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    @contextmanager
+    def update(self):
+        """
+        Context manager yielding the current document, written back once the
+        block exits without error. Other processes updating the same file
+        wait for the block to complete.
+        """
+        lock = self._lock()
+        try:
+            state = self.read()
+            yield state
+            self._write(state)
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def _lock(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by a concurrent process
+                pass
+        try:
+            lock = open(self.path + '.lock', 'a')
+        except (IOError, OSError):
+            # not writable, the write will fail and be logged
+            return None
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _write(self, state):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f)
+                os.rename(tmp, self.path)
+            except:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logger.warning('Unable to write the state file %s: %r', self.path, e)
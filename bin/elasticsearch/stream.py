@@ -0,0 +1,179 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import codecs
+
+from .exceptions import SerializationError
+
+_WHITESPACE = ' \t\n\r'
+
+
+class StreamedResponse(object):
+    """
+    Search or scroll response whose ``hits.hits`` array is decoded one hit at
+    a time while the body is still being read from the connection, so only
+    the hit being decoded (and one chunk of the body) is held in memory
+    instead of the whole page.
+
+    Iterating over the response yields the hits. Every other part of the body
+    is collected in ``meta`` with the same layout as the regular response,
+    minus ``hits.hits``. Keys sent before the hits (``_scroll_id``, ``took``,
+    ``hits.total``...) are available once the first hit has been yielded,
+    keys sent after them (``aggregations``...) only once the hits have been
+    consumed.
+
+    :arg chunks: iterable of the raw (utf-8 encoded) body chunks
+    :arg close: callable releasing the underlying connection, called with
+        ``True`` when the body was read entirely
+    :arg headers: headers of the response
+    """
+    def __init__(self, chunks, close=None, headers=None):
+        self.meta = {}
+        self.headers = headers or {}
+        self._chunks = iter(chunks)
+        self._close = close
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._hits = self._parse()
+
+    def __iter__(self):
+        return self._hits
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop reading the body and release the connection. A connection whose
+        body was not read entirely is closed instead of being reused.
+        """
+        self._hits.close()
+        if self._close is not None:
+            close, self._close = self._close, None
+            close(self._eof)
+
+    def consume(self):
+        """
+        Read (and discard) the remaining hits, filling ``meta`` entirely.
+        Returns the number of hits skipped.
+        """
+        count = 0
+        for _ in self._hits:
+            count += 1
+        return count
+
+    def raw(self):
+        """
+        Iterate over the body chunks as read, without decoding them, to pass
+        the body on as is. Can't be combined with iterating over the hits.
+        """
+        try:
+            for chunk in self._chunks:
+                yield chunk
+            self._eof = True
+        finally:
+            self.close()
+
+    def _fill(self):
+        """ Append the next chunk to the buffer, return False at the end. """
+        if self._eof:
+            return False
+        # drop the consumed part of the buffer so it never grows beyond the
+        # value being decoded plus one chunk
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+        self._buffer += self._decoder.decode(b'', True)
+        self._eof = True
+        if self._close is not None:
+            close, self._close = self._close, None
+            close(True)
+        return False
+
+    def _peek(self):
+        """ Skip whitespace and return the next character ('' at the end). """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise SerializationError(
+                'Unexpected %r in streamed response, expected one of %r.' % (char, chars))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """ Decode the next complete JSON value from the body. """
+        self._peek()
+        decoder = json.JSONDecoder()
+        need = 0
+        while True:
+            if self._eof or len(self._buffer) - self._pos >= need:
+                try:
+                    value, end = decoder.raw_decode(self._buffer, self._pos)
+                except ValueError as e:
+                    if self._eof:
+                        raise SerializationError(self._buffer[self._pos:], e)
+                else:
+                    # a number or literal ending the buffer may continue in the
+                    # next chunk, only accept it once it is terminated
+                    if self._eof or end < len(self._buffer):
+                        self._pos = end
+                        return value
+                # retry only once twice as much data is buffered, which keeps
+                # decoding a value spanning many chunks linear
+                need = 2 * (len(self._buffer) - self._pos)
+            self._fill()
+
+    def _members(self):
+        """ Iterate over the keys of the object at the current position. """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def _parse(self):
+        for key in self._members():
+            if key != 'hits' or self._peek() != '{':
+                self.meta[key] = self._value()
+                continue
+
+            hits = self.meta[key] = {}
+            for hits_key in self._members():
+                if hits_key != 'hits':
+                    hits[hits_key] = self._value()
+                    continue
+
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                    continue
+                while True:
+                    yield self._value()
+                    if self._expect(',]') == ']':
+                        break
+
+        if self._peek():
+            raise SerializationError('Trailing data in streamed response.')
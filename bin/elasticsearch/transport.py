@@ -1,11 +1,22 @@
 import time
+import logging
+import threading
+from contextlib import contextmanager
 from itertools import chain
 
 from .connection import Urllib3HttpConnection
 from .connection_pool import ConnectionPool, DummyConnectionPool
 from .serializer import JSONSerializer, Deserializer, DEFAULT_SERIALIZERS
+from .state import StateFile
+from .stream import StreamedResponse
 from .exceptions import ConnectionError, TransportError, SerializationError, \
                         ConnectionTimeout, ImproperlyConfigured
+from .compat import Queue, Empty
+
+logger = logging.getLogger('elasticsearch')
+
+# idempotent read APIs, safe to send twice when hedging
+HEDGE_ENDPOINTS = ('_search', '_count', '_msearch')
 
 
 def get_host_info(node_info, host):
@@ -39,7 +50,9 @@ class Transport(object):
         sniff_on_start=False, sniffer_timeout=None, sniff_timeout=.1,
         sniff_on_connection_fail=False, serializer=JSONSerializer(), serializers=None,
         default_mimetype='application/json', max_retries=3, retry_on_status=(502, 503, 504, ),
-        retry_on_timeout=False, send_get_body_as='GET', **kwargs):
+        retry_on_timeout=False, send_get_body_as='GET', hedge_percentile=None,
+        hedge_budget=.05, hedge_min_samples=20, hedge_state_path=None,
+        sniff_state_path=None, sniff_state_ttl=300, **kwargs):
         """
         :arg hosts: list of dictionaries, each containing keyword arguments to
             create a `connection_class` instance
@@ -72,6 +85,27 @@ class Transport(object):
             don't support passing bodies with GET requests. If you set this to
             'POST' a POST method will be used instead, if to 'source' then the body
             will be serialized and passed as a query parameter `source`.
+        :arg hedge_percentile: enables hedging of idempotent reads (search,
+            count and msearch without scroll): a request still pending after
+            this percentile (0-100) of the recent latencies of such requests is
+            sent again to another live connection and the first response wins
+        :arg hedge_budget: maximum share of the requests that may be hedged,
+            so hedging can't multiply the load of a struggling cluster
+            (default 5%)
+        :arg hedge_min_samples: number of latencies to observe before
+            hedging
+        :arg hedge_state_path: path of a file where the observed latencies
+            and the hedging budget are kept, shared by all the transports
+            using it, so short lived processes hedge from the latencies
+            observed by the previous ones
+        :arg sniff_state_path: path of a file where the sniffed hosts are
+            persisted, shared by all the transports using it. A new transport
+            starts from the hosts found there and sniffs again in a
+            background thread once they are older than ``sniff_state_ttl``.
+            ``sniff_on_start`` only sniffs synchronously while no hosts have
+            been persisted yet, ``sniffer_timeout`` is not used
+        :arg sniff_state_ttl: number of seconds the persisted hosts are used
+            before being refreshed
 
         Any extra keyword arguments will be passed to the `connection_class`
         when creating and instance unless overridden by that connection's
@@ -118,8 +152,27 @@ class Transport(object):
         # callback to construct host dict from data in /_cluster/nodes
         self.host_info_callback = host_info_callback
 
-        if sniff_on_start:
-            self.sniff_hosts(True)
+        # hedging state
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_state = StateFile(hedge_state_path) if hedge_state_path else None
+        self._hedge_window = max(hedge_min_samples, 200)
+        self._hedge = {'latencies': [], 'tokens': 0.}
+        self._hedge_lock = threading.Lock()
+
+        # persisted sniffing
+        self.sniff_state = StateFile(sniff_state_path) if sniff_state_path else None
+        self.sniff_state_ttl = sniff_state_ttl
+        self._sniff_thread = None
+
+        if self.sniff_state is not None and self._load_sniffed_hosts():
+            if time.time() >= self.last_sniff + sniff_state_ttl:
+                self._sniff_in_background()
+        elif sniff_on_start:
+            self._sniff_on_start()
+        elif self.sniff_state is not None:
+            self._sniff_in_background()
 
     def add_connection(self, host):
         """
@@ -166,7 +219,10 @@ class Transport(object):
         Retreive a :class:`~elasticsearch.Connection` instance from the
         :class:`~elasticsearch.ConnectionPool` instance.
         """
-        if self.sniffer_timeout:
+        if self.sniff_state is not None:
+            if time.time() >= self.last_sniff + self.sniff_state_ttl:
+                self._sniff_in_background()
+        elif self.sniffer_timeout:
             if time.time() >= self.last_sniff + self.sniffer_timeout:
                 self.sniff_hosts()
         return self.connection_pool.get_connection()
@@ -233,7 +289,13 @@ class Transport(object):
             (``sniff_on_start``), ignore the ``sniff_timeout`` if ``True``
         """
         node_info = self._get_sniff_data(initial)
+        self._set_sniffed_hosts(node_info)
 
+    def _set_sniffed_hosts(self, node_info):
+        """
+        Create a new connection pool from the node information returned by
+        :meth:`_get_sniff_data`.
+        """
         hosts = list(filter(None, (self._get_host_info(n) for n in node_info)))
 
         # we weren't able to get any nodes or host_info_callback blocked all -
@@ -242,6 +304,50 @@ class Transport(object):
             raise TransportError("N/A", "Unable to sniff hosts - no viable hosts found.")
 
         self.set_connections(hosts)
+        self._save_sniffed_hosts(hosts)
+
+    def _sniff_on_start(self):
+        self.sniff_hosts(True)
+
+    def _sniff_in_background(self):
+        """
+        Refresh the sniffed hosts from a daemon thread, requests keep using
+        the current connections meanwhile.
+        """
+        if self._sniff_thread is not None and self._sniff_thread.is_alive():
+            return
+        # don't try again before the ttl if this one fails
+        self.last_sniff = time.time()
+
+        def _sniff():
+            try:
+                # nobody waits on this thread, don't cut it at sniff_timeout
+                self.sniff_hosts(True)
+            except TransportError as e:
+                logger.warning('Background sniffing failed: %r', e)
+
+        self._sniff_thread = threading.Thread(target=_sniff)
+        self._sniff_thread.daemon = True
+        self._sniff_thread.start()
+
+    def _load_sniffed_hosts(self):
+        """
+        Use the hosts persisted in ``sniff_state`` if any, returns whether
+        there were.
+        """
+        state = self.sniff_state.read()
+        if not state.get('hosts'):
+            return False
+        self.set_connections(state['hosts'])
+        self.last_sniff = state.get('time', 0)
+        return True
+
+    def _save_sniffed_hosts(self, hosts):
+        if self.sniff_state is None:
+            return
+        with self.sniff_state.update() as state:
+            state['hosts'] = hosts
+            state['time'] = self.last_sniff
 
     def mark_dead(self, connection):
         """
@@ -255,26 +361,11 @@ class Transport(object):
         if self.sniff_on_connection_fail:
             self.sniff_hosts()
 
-    def perform_request(self, method, url, headers=None, params=None, body=None):
+    def _prepare_request(self, method, params, body):
         """
-        Perform the actual request. Retrieve a connection from the connection
-        pool, pass all the information to it's perform_request method and
-        return the data.
-
-        If an exception was raised, mark the connection as failed and retry (up
-        to `max_retries` times).
-
-        If the operation was succesful and the connection used was previously
-        marked as dead, mark it as live, resetting it's failure count.
-
-        :arg method: HTTP method to use
-        :arg url: absolute url (without host) to target
-        :arg headers: dictionary of headers, will be handed over to the
-            underlying :class:`~elasticsearch.Connection` class
-        :arg params: dictionary of query parameters, will be handed over to the
-            underlying :class:`~elasticsearch.Connection` class for serialization
-        :arg body: body of the request, will be serializes using serializer and
-            passed to the connection
+        Serialize the body and split the transport options out of ``params``,
+        returns ``(method, params, body, ignore, timeout, kwargs)`` with the
+        extra keyword arguments for the connection in ``kwargs``.
         """
         if body is not None:
             body = self.serializer.dumps(body)
@@ -301,31 +392,189 @@ class Transport(object):
 
         ignore = ()
         timeout = None
+        kwargs = {}
         if params:
             timeout = params.pop('request_timeout', None)
             ignore = params.pop('ignore', ())
             if isinstance(ignore, int):
                 ignore = (ignore, )
+            if params.pop('stream', False):
+                kwargs['stream'] = True
+
+        return method, params, body, ignore, timeout, kwargs
+
+    def _should_retry(self, error):
+        """
+        Whether a failed request should be retried on another connection.
+        """
+        if isinstance(error, ConnectionTimeout):
+            return self.retry_on_timeout
+        if isinstance(error, ConnectionError):
+            return True
+        return error.status_code in self.retry_on_status
+
+    def _hedgeable(self, method, url, params, kwargs):
+        """
+        Whether a request is an idempotent read that may be hedged.
+        """
+        return bool(self.hedge_percentile) and set(kwargs) <= set(['stream']) \
+            and method in ('GET', 'POST') \
+            and url.rstrip('/').rsplit('/', 1)[-1] in HEDGE_ENDPOINTS \
+            and not (params and 'scroll' in params)
+
+    @contextmanager
+    def _hedge_stats(self):
+        """
+        Context manager yielding the latencies observed and the hedging
+        budget, from ``hedge_state`` when shared.
+        """
+        with self._hedge_lock:
+            if self.hedge_state is None:
+                yield self._hedge
+            else:
+                with self.hedge_state.update() as state:
+                    state.setdefault('latencies', [])
+                    state.setdefault('tokens', 0.)
+                    yield state
+
+    def _hedge_delay(self):
+        """
+        Time to wait before hedging a request, ``None`` until enough latencies
+        have been observed. Each call earns ``hedge_budget`` of a hedge.
+        """
+        with self._hedge_stats() as stats:
+            stats['tokens'] = min(stats['tokens'] + self.hedge_budget, 1. + self.hedge_budget)
+            if len(stats['latencies']) < self.hedge_min_samples:
+                return None
+            latencies = sorted(stats['latencies'])
+        return latencies[int(self.hedge_percentile / 100. * (len(latencies) - 1))]
+
+    def _take_hedge(self):
+        with self._hedge_stats() as stats:
+            if stats['tokens'] < 1:
+                return False
+            stats['tokens'] -= 1
+            return True
+
+    def _record_latency(self, duration):
+        with self._hedge_stats() as stats:
+            stats['latencies'] = stats['latencies'][1 - self._hedge_window:] + [duration]
+
+    def _hedged_request(self, connection, delay, method, url, params, body, headers, ignore, timeout, **kwargs):
+        """
+        Send a request on ``connection`` and, if it hasn't answered within
+        ``delay`` seconds and the budget allows, once more on another live
+        connection. Returns the connection that answered first with its
+        response, the slower request is abandoned and its streamed body, if
+        any, closed. When both fail the error of ``connection`` is raised.
+        """
+        results = Queue()
+        answered = []
+        lock = threading.Lock()
+
+        def _send(conn):
+            try:
+                response = conn.perform_request(method, url, params, body, headers=headers, ignore=ignore, timeout=timeout, **kwargs)
+            except Exception as e:
+                results.put((conn, e, None))
+                return
+            with lock:
+                if not answered:
+                    answered.append(conn)
+                    results.put((conn, None, response))
+                    return
+            # the other request won, release the connection held by the stream
+            if isinstance(response[2], StreamedResponse):
+                response[2].close()
+
+        def _start(conn):
+            thread = threading.Thread(target=_send, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+        _start(connection)
+        pending = 1
+        try:
+            result = results.get(timeout=delay)
+        except Empty:
+            others = [c for c in self.connection_pool.connections if c is not connection]
+            if others and self._take_hedge():
+                other = self.connection_pool.selector.select(others) if len(others) > 1 else others[0]
+                logger.info('Hedging %s %s on %r after %.3fs.', method, url, other, delay)
+                _start(other)
+                pending = 2
+            result = results.get()
+
+        errors = {}
+        while True:
+            conn, error, response = result
+            if error is None:
+                break
+            errors[conn] = error
+            pending -= 1
+            if not pending:
+                break
+            result = results.get()
+
+        # the caller marks the original connection when reporting its error
+        for failed, failed_error in errors.items():
+            if (error is None or failed is not connection) and \
+                    isinstance(failed_error, TransportError) and self._should_retry(failed_error):
+                self.mark_dead(failed)
+
+        if error is None:
+            return conn, response
+        raise errors[connection]
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        """
+        Perform the actual request. Retrieve a connection from the connection
+        pool, pass all the information to it's perform_request method and
+        return the data.
+
+        If an exception was raised, mark the connection as failed and retry (up
+        to `max_retries` times).
+
+        If the operation was succesful and the connection used was previously
+        marked as dead, mark it as live, resetting it's failure count.
+
+        :arg method: HTTP method to use
+        :arg url: absolute url (without host) to target
+        :arg headers: dictionary of headers, will be handed over to the
+            underlying :class:`~elasticsearch.Connection` class
+        :arg params: dictionary of query parameters, will be handed over to the
+            underlying :class:`~elasticsearch.Connection` class for serialization
+        :arg body: body of the request, will be serializes using serializer and
+            passed to the connection
+
+        A ``stream`` entry in ``params`` requests the body of a successful
+        search or scroll response to be returned as a
+        :class:`~elasticsearch.stream.StreamedResponse`, decoding the hits
+        while they are read, instead of being deserialized at once.
+        """
+        method, params, body, ignore, timeout, kwargs = self._prepare_request(method, params, body)
+
+        hedgeable = self._hedgeable(method, url, params, kwargs)
+        hedge_delay = self._hedge_delay() if hedgeable else None
 
         for attempt in range(self.max_retries + 1):
             connection = self.get_connection()
 
             try:
-                status, headers, data = connection.perform_request(method, url, params, body, headers=headers, ignore=ignore, timeout=timeout)
+                start = time.time()
+                if hedge_delay is not None and attempt == 0:
+                    connection, (status, headers, data) = self._hedged_request(
+                        connection, hedge_delay, method, url, params, body, headers, ignore, timeout, **kwargs)
+                else:
+                    status, headers, data = connection.perform_request(method, url, params, body, headers=headers, ignore=ignore, timeout=timeout, **kwargs)
+                if hedgeable:
+                    self._record_latency(time.time() - start)
 
             except TransportError as e:
                 if method == 'HEAD' and e.status_code == 404:
                     return False
 
-                retry = False
-                if isinstance(e, ConnectionTimeout):
-                    retry = self.retry_on_timeout
-                elif isinstance(e, ConnectionError):
-                    retry = True
-                elif e.status_code in self.retry_on_status:
-                    retry = True
-
-                if retry:
+                if self._should_retry(e):
                     # only mark as dead if we are retrying
                     self.mark_dead(connection)
                     # raise exception on last retry
@@ -336,11 +585,14 @@ class Transport(object):
 
             else:
                 if method == 'HEAD':
+                    if isinstance(data, StreamedResponse):
+                        # release the pooled connection, there is no body
+                        data.close()
                     return 200 <= status < 300
 
                 # connection didn't fail, confirm it's live status
                 self.connection_pool.mark_live(connection)
-                if data:
+                if data and not isinstance(data, StreamedResponse):
                     data = self.deserializer.loads(data, headers.get('content-type'))
                 return data
 
@@ -9,12 +9,21 @@ import re
 import sys
 import json
 import time
+import numbers
+import calendar
+import hashlib
+import tempfile
+import zlib
 from pprint import pprint
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, helpers, NotFoundError
+from elasticsearch.compat import string_types
 from splunklib.searchcommands import \
     dispatch, GeneratingCommand, Configuration, Option, validators
 
 
+# App directory
+APP_PATH = os.path.dirname(os.path.abspath(__file__)) + "/.."
+
 # Time units for relative time conversion
 UNITS = {
     "s": 1,
@@ -28,17 +37,71 @@ UNITS = {
 # Elasticsearch document metadata keys
 KEYS_ELASTIC = ("_index", "_type", "_id", "_score")
 KEY_ELASTIC_SOURCE = "_source"
+KEY_ELASTIC_FIELDS = "fields"
+
+# Coercion of mapped field types, other types are passed as is
+COERCE_TYPES = {
+    "long": int,
+    "integer": int,
+    "short": int,
+    "byte": int,
+    "double": float,
+    "float": float,
+    "half_float": float,
+    "scaled_float": float,
+}
+
+# ISO 8601 timestamps as produced by the default date formats
+RE_ISO_TIMESTAMP = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?)?"
+                              r"(Z|[+-]\d{2}:?\d{2})?$")
+
+# Field types that have doc values unless disabled in the mapping
+DOCVALUE_TYPES = ("keyword", "long", "integer", "short", "byte", "double", "float",
+                  "half_float", "scaled_float", "date", "boolean", "ip")
 
 # Supported actions
 ACTION_SEARCH = "search"
 ACTION_INDICES_LIST = "indices-list"
 ACTION_CLUSTER_HEALTH = "cluster-health"
+ACTION_STATS = "stats"
+ACTION_TIMECHART = "timechart"
+
+# Supported projections
+PROJECTION_SOURCE = "source"
+PROJECTION_DOCVALUES = "docvalues"
+
+# Supported hit decoders
+DECODE_DYNAMIC = "dynamic"
+DECODE_MAPPING = "mapping"
+
+# Supported caches
+CACHE_NONE = "none"
+CACHE_RESULTS = "results"
+CACHE_INCREMENTAL = "incremental"
+
+# Supported search modes
+MODE_SEARCH = "search"
+MODE_SCAN = "scan"
+MODE_SEARCH_AFTER = "search_after"
+MODE_AUTO = "auto"
 
 # Config keys
 KEY_CONFIG_EADDR = "hosts"
 KEY_CONFIG_TIMESTAMP = "tsfield"
 KEY_CONFIG_USE_SSL = "use_ssl"
 KEY_CONFIG_VERIFY_CERTS = "verify_certs"
+KEY_CONFIG_HTTP_COMPRESS = "http_compress"
+KEY_CONFIG_HTTP_COMPRESS_MIN_BYTES = "http_compress_min_bytes"
+KEY_CONFIG_BROKER = "broker"
+KEY_CONFIG_BROKER_SOCKET = "broker_socket"
+KEY_CONFIG_BROKER_IDLE_TIMEOUT = "broker_idle_timeout"
+KEY_CONFIG_SELECTOR = "selector"
+KEY_CONFIG_HEDGE_PERCENTILE = "hedge_percentile"
+KEY_CONFIG_HEDGE_BUDGET = "hedge_budget"
+KEY_CONFIG_SNIFF = "sniff"
+KEY_CONFIG_SNIFF_TTL = "sniff_ttl"
+KEY_CONFIG_SHARE_DEAD_NODES = "share_dead_nodes"
+KEY_CONFIG_HEALTH_CHECK = "health_check"
 KEY_CONFIG_FIELDS = "fields"
 KEY_CONFIG_SOURCE_TYPE = "stype"
 KEY_CONFIG_LATEST = "latest"
@@ -49,32 +112,272 @@ KEY_CONFIG_INCLUDE_ES = "include_es"
 KEY_CONFIG_INCLUDE_RAW = "include_raw"
 KEY_CONFIG_LIMIT = "limit"
 KEY_CONFIG_QUERY = "query"
+KEY_CONFIG_SLICES = "slices"
+KEY_CONFIG_MODE = "mode"
+KEY_CONFIG_WINDOWS = "windows"
+KEY_CONFIG_SHARDS = "shards"
+KEY_CONFIG_PREFETCH = "prefetch"
+KEY_CONFIG_STREAM = "stream"
+KEY_CONFIG_PAGE_SIZE = "page_size"
+KEY_CONFIG_BY = "by"
+KEY_CONFIG_STATS = "stats"
+KEY_CONFIG_BUCKETS = "buckets"
+KEY_CONFIG_COMPOSITE = "composite"
+KEY_CONFIG_SPAN = "span"
+KEY_CONFIG_PROJECTION = "projection"
+KEY_CONFIG_DOCVALUE_FIELDS = "docvalue_fields"
+KEY_CONFIG_STORED_FIELDS = "stored_fields"
+KEY_CONFIG_INDEX_DATE_FORMAT = "index_date_format"
+KEY_CONFIG_CACHE = "cache"
+KEY_CONFIG_CACHE_TTL = "cache_ttl"
+KEY_CONFIG_CACHE_MAX_BYTES = "cache_max_bytes"
+KEY_CONFIG_CACHE_MAX_EVENTS = "cache_max_events"
+KEY_CONFIG_CACHE_BUCKET_SPAN = "cache_bucket_span"
+KEY_CONFIG_CACHE_BUCKET_TTL = "cache_bucket_ttl"
+KEY_CONFIG_CACHE_SETTLE = "cache_settle"
+KEY_CONFIG_INCLUDE_LATEST = "include_latest"
+KEY_CONFIG_DECODE = "decode"
+KEY_CONFIG_DECODE_PLANS = "decode_plans"
+KEY_CONFIG_MAPPING_TTL = "mapping_ttl"
+KEY_CONFIG_PLAN_SEARCH_HITS = "plan_search_hits"
+KEY_CONFIG_PLAN_PARALLEL_HITS = "plan_parallel_hits"
+KEY_CONFIG_PLAN_MAX_SLICES = "plan_max_slices"
+
+# Config keys that only affect how results are fetched, not the results
+KEYS_CONFIG_EXECUTION = (KEY_CONFIG_SCAN, KEY_CONFIG_MODE, KEY_CONFIG_SLICES,
+                         KEY_CONFIG_SHARDS, KEY_CONFIG_PREFETCH, KEY_CONFIG_STREAM,
+                         KEY_CONFIG_PAGE_SIZE,
+                         KEY_CONFIG_PLAN_SEARCH_HITS, KEY_CONFIG_PLAN_PARALLEL_HITS,
+                         KEY_CONFIG_PLAN_MAX_SLICES, KEY_CONFIG_CACHE, KEY_CONFIG_CACHE_TTL,
+                         KEY_CONFIG_CACHE_MAX_BYTES, KEY_CONFIG_CACHE_MAX_EVENTS,
+                         KEY_CONFIG_CACHE_BUCKET_SPAN, KEY_CONFIG_CACHE_BUCKET_TTL,
+                         KEY_CONFIG_CACHE_SETTLE, KEY_CONFIG_DECODE_PLANS,
+                         KEY_CONFIG_MAPPING_TTL, KEY_CONFIG_HTTP_COMPRESS,
+                         KEY_CONFIG_HTTP_COMPRESS_MIN_BYTES, KEY_CONFIG_BROKER,
+                         KEY_CONFIG_BROKER_SOCKET, KEY_CONFIG_BROKER_IDLE_TIMEOUT,
+                         KEY_CONFIG_SELECTOR,
+                         KEY_CONFIG_HEDGE_PERCENTILE, KEY_CONFIG_HEDGE_BUDGET,
+                         KEY_CONFIG_SNIFF, KEY_CONFIG_SNIFF_TTL,
+                         KEY_CONFIG_SHARE_DEAD_NODES, KEY_CONFIG_HEALTH_CHECK)
 
 # Splunk keys
 KEY_SPLUNK_TIMESTAMP = "_time"
 KEY_SPLUNK_EARLIEST = "startTime"
 KEY_SPLUNK_LATEST = "endTime"
+KEY_SPLUNK_NOW = "now"
 KEY_SPLUNK_RAW = "_raw"
 
+# Stats functions and the Elasticsearch metric aggregation computing them
+STATS_FUNCTIONS = {
+    "count": "value_count",
+    "sum": "sum",
+    "avg": "avg",
+    "min": "min",
+    "max": "max",
+    "dc": "cardinality",
+}
+
+# Timechart spans in seconds, the smallest one giving at most bins buckets is used
+TIMECHART_SPANS = (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 10800, 21600, 43200,
+                   86400, 604800, 2592000)
+
+# Index name date directives, their pattern and the period they span in seconds
+# (months and years are computed from the calendar)
+INDEX_DATE_DIRECTIVES = {
+    "%Y": (r"\d{4}", "y"),
+    "%m": (r"\d{2}", "M"),
+    "%d": (r"\d{2}", "d"),
+    "%H": (r"\d{2}", "h"),
+}
+
+# Longest pruned index list, leaving room in the request line for the
+# rest of the url (http.max_initial_line_length is 4KB by default)
+INDEX_PRUNE_MAX_LENGTH = 3072
+
+# Histogram buckets per time window used to balance windows
+WINDOWS_PROBE_RESOLUTION = 10
+
+# Execution planner defaults, overridable per cluster in elasticsplunk.json
+DEFAULT_PLAN_SEARCH_HITS = 1000
+# Default index.max_result_window, the largest size of a single search
+PLAN_MAX_SEARCH_HITS = 10000
+DEFAULT_PLAN_PARALLEL_HITS = 100000
+DEFAULT_PLAN_MAX_SLICES = 8
+
+# Result cache defaults, overridable per cluster in elasticsplunk.json
+DEFAULT_CACHE_PATH = APP_PATH + "/cache/results"
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_CACHE_MAX_EVENTS = 100000
+DEFAULT_CACHE_BUCKETS_PATH = APP_PATH + "/cache/buckets"
+DEFAULT_CACHE_BUCKET_SPAN = 3600
+DEFAULT_CACHE_BUCKET_TTL = 86400
+DEFAULT_CACHE_SETTLE = 300
+DEFAULT_MAPPINGS_PATH = APP_PATH + "/cache/mappings"
+DEFAULT_MAPPING_TTL = 3600
+
+# HTTP compression defaults, overridable per cluster in elasticsplunk.json
+DEFAULT_HTTP_COMPRESS = False
+DEFAULT_HTTP_COMPRESS_MIN_BYTES = 64 * 1024
+
+# Connection broker defaults, overridable per cluster in elasticsplunk.json
+DEFAULT_BROKER = False
+DEFAULT_BROKER_SOCKET = APP_PATH + "/run/essbroker.sock"
+
+# Connection selector among the live nodes: round_robin, random or adaptive
+DEFAULT_SELECTOR = "round_robin"
+
+# Hedging of search requests, disabled unless a percentile is configured
+DEFAULT_HEDGE_PERCENTILE = None
+DEFAULT_HEDGE_BUDGET = 0.05
+DEFAULT_HEDGE_PATH = APP_PATH + "/cache/hedge"
+
+# Sniffed cluster nodes, persisted for the following searches
+DEFAULT_SNIFF = False
+DEFAULT_SNIFF_PATH = APP_PATH + "/cache/sniff"
+DEFAULT_SNIFF_TTL = 300
+
+# Nodes failing for a search are retired for the following ones too
+DEFAULT_SHARE_DEAD_NODES = True
+DEFAULT_DEAD_NODES_PATH = APP_PATH + "/cache/dead"
+
+# Dead nodes are probed in the background before being used again
+DEFAULT_HEALTH_CHECK = True
+
 # Default time range
 DEFAULT_EARLIEST = "now-24h"
 DEFAULT_LATEST = "now"
 
+class DiskCache(object):
+    """Size bounded LRU cache of JSON values stored as compressed files,
+    shared by concurrent search processes"""
+
+    def __init__(self, path, ttl, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Created by a concurrent search
+                pass
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".cache")
+
+    def get(self, key):
+        """Return the cached value or None when missing or expired"""
+
+        path = self._file(key)
+        try:
+            mtime = os.path.getmtime(path)
+            if time.time() - mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as data:
+                value = json.loads(zlib.decompress(data.read()).decode("utf-8"))
+            # Access time tracks recency for the LRU eviction
+            os.utime(path, (time.time(), mtime))
+            return value
+        except (OSError, IOError, ValueError, zlib.error):
+            return None
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries over max_bytes.
+        Returns False when the entry couldn't be written"""
+
+        data = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        # Readers only ever see complete files
+        try:
+            handle, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            try:
+                with os.fdopen(handle, "wb") as tmpfile:
+                    tmpfile.write(data)
+                os.rename(tmp, self._file(key))
+            except:
+                os.remove(tmp)
+                raise
+        except (OSError, IOError):
+            # A full or read only disk costs the cache, not the search
+            return False
+        self._evict()
+        return True
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".cache"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
 @Configuration()
 class ElasticSplunk(GeneratingCommand):
     """ElasticSplunk custom search command"""
 
-    action = Option(require=False, default=ACTION_SEARCH, doc="[search,indices-list,cluster-health")
+    action = Option(require=False, default=ACTION_SEARCH,
+                    doc="[search,stats,timechart,indices-list,cluster-health")
     eaddr = Option(require=True, default=None, doc="server:port,server:port or config item")
     index = Option(require=False, default=None, doc="Index to search")
     #index = Option(require=False, default="_all", doc="Index to search")
-    scan = Option(require=False, default=True, doc="Perform a scan search")
+    scan = Option(require=False, default=None, doc="Perform a scan search")
+    mode = Option(require=False, default=None,
+                  validate=validators.Set(MODE_SEARCH, MODE_SCAN, MODE_SEARCH_AFTER, MODE_AUTO),
+                  doc="[search,scan,search_after,auto] overrides scan when specified")
     stype = Option(require=False, default=None, doc="Source/doc_type")
     tsfield = Option(require=False, default="@timestamp", doc="Field holding the event timestamp")
     query = Option(require=False, default="*", doc="Query string in ES DSL")
     fields = Option(require=False, default=None, doc="Only include selected fields")
-    limit = Option(require=False, default=10000, doc="Max number of hits")
-    include_es = Option(require=False, default=False, doc="Include Elasticsearch relevant fields")
+    projection = Option(require=False, default=PROJECTION_SOURCE,
+                        validate=validators.Set(PROJECTION_SOURCE, PROJECTION_DOCVALUES),
+                        doc="[source,docvalues] fetch the selected fields from _source or doc values")
+    limit = Option(require=False, default=10000, validate=validators.Integer(minimum=1),
+                   doc="Max number of hits")
+    page_size = Option(require=False, default=1000, validate=validators.Integer(minimum=1),
+                       doc="Number of hits fetched per request when paging")
+    slices = Option(require=False, default=1, validate=validators.Integer(minimum=1),
+                    doc="Number of sliced scrolls to fetch in parallel when scanning")
+    prefetch = Option(require=False, default=1, validate=validators.Integer(minimum=0),
+                      doc="Number of result pages fetched ahead in the background")
+    stream = Option(require=False, default=False, validate=validators.Boolean(),
+                    doc="Decode hits while the response is read instead of loading whole pages")
+    shards = Option(require=False, default=False, validate=validators.Boolean(),
+                    doc="Run one scroll per shard group in parallel when scanning")
+    windows = Option(require=False, default=1, validate=validators.Integer(minimum=1),
+                     doc="Number of time windows to fetch in parallel, merged in time order")
+    by = Option(require=False, default=None, doc="Fields to group by with action=stats")
+    stats = Option(require=False, default="count",
+                   doc="Functions to compute with action=stats eg. count,avg(bytes),dc(user)")
+    buckets = Option(require=False, default=1000, validate=validators.Integer(minimum=1),
+                     doc="Max number of buckets per group by field with action=stats")
+    composite = Option(require=False, default=False, validate=validators.Boolean(),
+                       doc="Stream action=stats buckets with paged composite aggregations")
+    span = Option(require=False, default=None,
+                  doc="Bucket span with action=timechart eg. 5m, derived from bins if not specified")
+    bins = Option(require=False, default=100, validate=validators.Integer(minimum=1),
+                  doc="Target number of time buckets with action=timechart")
+    cache = Option(require=False, default=CACHE_NONE,
+                   validate=validators.Set(CACHE_NONE, CACHE_RESULTS, CACHE_INCREMENTAL),
+                   doc="[none,results,incremental] serve repeated searches from a local cache")
+    decode = Option(require=False, default=DECODE_DYNAMIC, validate=validators.Set(DECODE_DYNAMIC, DECODE_MAPPING),
+                    doc="[dynamic,mapping] decode hits by probing them or from a plan built from the mappings")
+    include_es = Option(require=False, default=False, validate=validators.Boolean(),
+                        doc="Include Elasticsearch relevant fields")
     include_raw = Option(require=False, default=False, doc="Include event source")
     use_ssl = Option(require=False, default=None, doc="Use SSL")
     verify_certs = Option(require=False, default=None, doc="Verify SSL Certificates")
@@ -111,12 +414,30 @@ class ElasticSplunk(GeneratingCommand):
             return int(time.mktime(time.strptime(time_value, "%Y-%m-%dT%H:%M:%S")))
 
 
+    def _cache_set(self, cache, key, value):
+        """Store a value in a disk cache, reporting failures in the job inspector"""
+
+        if not cache.set(key, value):
+            self.write_warning("ess cache: unable to store key={0} in {1}".format(key, cache.path))
+
+    def _ends_now(self):
+        """Whether the time range ends at the time of the search, as with
+        latest="now" or a relative time picker range, and so moves with
+        every run"""
+
+        if self.latest:
+            return self.latest == "now"
+        info = self.search_results_info
+        if hasattr(info, KEY_SPLUNK_LATEST):
+            now = getattr(info, KEY_SPLUNK_NOW, None)
+            return now is not None and int(info.endTime) >= int(now)
+        return DEFAULT_LATEST == "now"
+
     def _get_search_config(self):
         """Parse and configure search parameters"""
 
         # Load default configs if available
-        app_path = os.path.dirname(os.path.abspath(__file__)) + "/.."
-        local_config = "{0}/local/elasticsplunk.json".format(app_path)
+        local_config = "{0}/local/elasticsplunk.json".format(APP_PATH)
         if os.path.isfile(local_config):
             config_file = open(local_config)
             config = json.load(config_file)
@@ -172,11 +493,36 @@ class ElasticSplunk(GeneratingCommand):
             config[KEY_CONFIG_EARLIEST] = config[KEY_CONFIG_LATEST] - self.parse_dates(DEFAULT_EARLIEST)
 
         config[KEY_CONFIG_SCAN] = True if self.scan in [True, "true", "True", 1, "y"] else False
+        if self.mode:
+            config[KEY_CONFIG_MODE] = self.mode
+        elif self.scan is not None:
+            config[KEY_CONFIG_MODE] = MODE_SCAN if config[KEY_CONFIG_SCAN] else MODE_SEARCH
+        else:
+            config[KEY_CONFIG_MODE] = MODE_AUTO
         config[KEY_CONFIG_INDEX] = self.index
         config[KEY_CONFIG_INCLUDE_ES] = self.include_es
         config[KEY_CONFIG_INCLUDE_RAW] = self.include_raw
         config[KEY_CONFIG_LIMIT] = self.limit
         config[KEY_CONFIG_QUERY] = self.query
+        config[KEY_CONFIG_SLICES] = self.slices
+        config[KEY_CONFIG_WINDOWS] = self.windows
+        config[KEY_CONFIG_SHARDS] = self.shards
+        config[KEY_CONFIG_PREFETCH] = self.prefetch
+        config[KEY_CONFIG_STREAM] = self.stream
+        config[KEY_CONFIG_BY] = self.by.split(",") if self.by else []
+        config[KEY_CONFIG_STATS] = _parse_stats(self.stats)
+        config[KEY_CONFIG_BUCKETS] = self.buckets
+        config[KEY_CONFIG_COMPOSITE] = self.composite
+        config[KEY_CONFIG_SPAN] = self._timechart_span(config)
+        config[KEY_CONFIG_PROJECTION] = self.projection
+        config[KEY_CONFIG_DOCVALUE_FIELDS] = None
+        config[KEY_CONFIG_CACHE] = self.cache
+        config[KEY_CONFIG_INCLUDE_LATEST] = True
+        config[KEY_CONFIG_DECODE] = self.decode
+        config[KEY_CONFIG_DECODE_PLANS] = None
+        config[KEY_CONFIG_STORED_FIELDS] = None
+        # Never fetch pages larger than the whole result
+        config[KEY_CONFIG_PAGE_SIZE] = min(self.page_size, self.limit)
 
         return config
 
@@ -185,13 +531,40 @@ class ElasticSplunk(GeneratingCommand):
         """Parse a Elasticsearch Hit"""
 
         event = {}
-        event[KEY_SPLUNK_TIMESTAMP] = hit[KEY_ELASTIC_SOURCE][config[KEY_CONFIG_TIMESTAMP]]
-        for key in hit[KEY_ELASTIC_SOURCE]:
-            if key != config[KEY_CONFIG_TIMESTAMP]:
-                if isinstance(hit[KEY_ELASTIC_SOURCE][key], dict):
-                    event.update(_flattern(key, hit[KEY_ELASTIC_SOURCE][key]))
+        source = hit.get(KEY_ELASTIC_SOURCE, {})
+        plan = config[KEY_CONFIG_DECODE_PLANS].get(hit.get("_index")) \
+            if config[KEY_CONFIG_DECODE_PLANS] else None
+        if plan is not None:
+            for key in source:
+                decoder = plan.get(key)
+                if decoder is not None:
+                    decoder(event, source[key])
+                # Not in the mapping (eg. dynamic: false)
+                elif isinstance(source[key], dict):
+                    event.update(_flattern(key, source[key]))
                 else:
-                    event[key] = hit[KEY_ELASTIC_SOURCE][key]
+                    event[key] = source[key]
+        else:
+            if config[KEY_CONFIG_TIMESTAMP] in source:
+                event[KEY_SPLUNK_TIMESTAMP] = source[config[KEY_CONFIG_TIMESTAMP]]
+            for key in source:
+                if key != config[KEY_CONFIG_TIMESTAMP]:
+                    if isinstance(source[key], dict):
+                        event.update(_flattern(key, source[key]))
+                    else:
+                        event[key] = source[key]
+
+        # Doc values and stored fields, always returned as lists
+        fields = hit.get(KEY_ELASTIC_FIELDS, {})
+        for key in fields:
+            value = fields[key][0] if len(fields[key]) == 1 else fields[key]
+            if key == config[KEY_CONFIG_TIMESTAMP]:
+                # Date doc values are epoch milliseconds
+                if isinstance(value, numbers.Number):
+                    value = value / 1000.0
+                event[KEY_SPLUNK_TIMESTAMP] = value
+            else:
+                event[key] = value
 
         if config[KEY_CONFIG_INCLUDE_ES]:
             for key in KEYS_ELASTIC:
@@ -202,6 +575,68 @@ class ElasticSplunk(GeneratingCommand):
 
         return event
 
+    def _decode_plans(self, esclient, config):
+        """Build per index decode plans from the index mappings, cached on disk"""
+
+        # Already built for a search split in several parts
+        if config[KEY_CONFIG_DECODE] != DECODE_MAPPING or config[KEY_CONFIG_DECODE_PLANS] is not None:
+            return
+
+        cache = DiskCache(DEFAULT_MAPPINGS_PATH,
+                          config.get(KEY_CONFIG_MAPPING_TTL, DEFAULT_MAPPING_TTL),
+                          config.get(KEY_CONFIG_CACHE_MAX_BYTES, DEFAULT_CACHE_MAX_BYTES))
+        key = _fingerprint("mapping", {
+            KEY_CONFIG_EADDR: config[KEY_CONFIG_EADDR],
+            KEY_CONFIG_INDEX: config[KEY_CONFIG_INDEX],
+            KEY_CONFIG_SOURCE_TYPE: config[KEY_CONFIG_SOURCE_TYPE],
+        })
+        mappings = cache.get(key)
+        if mappings is None:
+            mappings = esclient.indices.get_mapping(index=config[KEY_CONFIG_INDEX],
+                                                    doc_type=config[KEY_CONFIG_SOURCE_TYPE])
+            self._cache_set(cache, key, mappings)
+
+        plans = {}
+        for index, mapping in mappings.items():
+            properties = {}
+            for doc_type in mapping.get("mappings", {}).values():
+                properties.update(doc_type.get("properties", {}))
+            plan = _decode_plan(properties)
+            timestamp = _field_mapping(properties, config[KEY_CONFIG_TIMESTAMP]) or {}
+            plan[config[KEY_CONFIG_TIMESTAMP]] = _timestamp_decoder(timestamp.get("format"))
+            plans[index] = plan
+        config[KEY_CONFIG_DECODE_PLANS] = plans
+
+    def _project(self, esclient, config):
+        """Move the selected fields that can be read from doc values or stored
+        fields out of _source, as decided from the index mappings"""
+
+        if config[KEY_CONFIG_PROJECTION] != PROJECTION_DOCVALUES or not config[KEY_CONFIG_FIELDS] \
+                or config[KEY_CONFIG_DOCVALUE_FIELDS] is not None:
+            return
+
+        mappings = esclient.indices.get_field_mapping(fields=",".join(config[KEY_CONFIG_FIELDS]),
+                                                      index=config[KEY_CONFIG_INDEX],
+                                                      doc_type=config[KEY_CONFIG_SOURCE_TYPE])
+        docvalues = {}
+        stored = {}
+        for index in mappings.values():
+            for doc_type in index.get("mappings", {}).values():
+                for name, field in doc_type.items():
+                    for mapping in field.get("mapping", {}).values():
+                        # A field must be eligible in every index it is mapped in
+                        docvalues[name] = docvalues.get(name, True) and \
+                            mapping.get("type") in DOCVALUE_TYPES and \
+                            mapping.get("doc_values", True) is not False
+                        stored[name] = stored.get(name, True) and mapping.get("store", False) is True
+
+        config[KEY_CONFIG_DOCVALUE_FIELDS] = [f for f in config[KEY_CONFIG_FIELDS] if docvalues.get(f)]
+        source_fields = [f for f in config[KEY_CONFIG_FIELDS] if not docvalues.get(f)]
+        # Stored fields only pay off when _source can be skipped altogether
+        if all(stored.get(f) for f in source_fields):
+            config[KEY_CONFIG_STORED_FIELDS] = source_fields
+            source_fields = []
+        config[KEY_CONFIG_FIELDS] = source_fields or None
 
     def _list_indices(self, esclient):
         """List indices in given Elasticsearch nodes"""
@@ -226,70 +661,727 @@ class ElasticSplunk(GeneratingCommand):
         status[KEY_SPLUNK_TIMESTAMP] = int(time.time())
         yield status
 
-    def _search(self, esclient, config):
-        """Search Generate events to Splunk from a Elasticsearch search"""
+    def _search_body(self, config, earliest, latest, include_latest=True):
+        """Build the search body for the given time range"""
 
-        # Search body
         # query-string-syntax
         # www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
+        clauses = [
+            {"range": {
+                config[KEY_CONFIG_TIMESTAMP]: {
+                    "gte": earliest,
+                    "lte" if include_latest else "lt": latest,
+                    "format": "epoch_second",
+                }
+            }},
+            {"query_string" : {
+                "query" : config[KEY_CONFIG_QUERY],
+            }}
+        ]
+
+        # Scores are only returned with include_es, otherwise run both clauses
+        # in filter context: no scoring and cacheable in the node query cache
+        if config[KEY_CONFIG_INCLUDE_ES]:
+            query = {"bool": {"must": clauses}}
+        else:
+            query = {"bool": {"filter": clauses}}
+
         body = {
             "sort":[{config[KEY_CONFIG_TIMESTAMP]:{"order": "asc"}}],
-            "query": {
-                "bool": {
-                    "must": [
-                        {"range": {
-                            config[KEY_CONFIG_TIMESTAMP]: {
-                                "gte": config[KEY_CONFIG_EARLIEST],
-                                "lte": config[KEY_CONFIG_LATEST],
-                                "format": "epoch_second",
-                            }
-                        }},
-                        {"query_string" : {
-                            "query" : config[KEY_CONFIG_QUERY],
-                        }}
-                    ]
+            "track_scores": bool(config[KEY_CONFIG_INCLUDE_ES]),
+            "query": query,
+        }
+
+        # Projection pushdown, skip _source when every field has another source
+        if config[KEY_CONFIG_DOCVALUE_FIELDS] or config[KEY_CONFIG_STORED_FIELDS]:
+            body["docvalue_fields"] = config[KEY_CONFIG_DOCVALUE_FIELDS] or []
+            if config[KEY_CONFIG_STORED_FIELDS]:
+                body["stored_fields"] = config[KEY_CONFIG_STORED_FIELDS]
+            if not config[KEY_CONFIG_FIELDS]:
+                body["_source"] = False
+
+        return body
+
+    def _time_windows(self, esclient, config, body):
+        """Split the search time range in windows holding about the same number of hits"""
+
+        earliest = config[KEY_CONFIG_EARLIEST]
+        latest = config[KEY_CONFIG_LATEST]
+        windows = config[KEY_CONFIG_WINDOWS]
+
+        # Probe the hit distribution with a cheap date histogram
+        interval = max(1, (latest - earliest) // (windows * WINDOWS_PROBE_RESOLUTION))
+        probe = {
+            "size": 0,
+            "query": body["query"],
+            "aggs": {
+                "hits": {
+                    "date_histogram": {
+                        "field": config[KEY_CONFIG_TIMESTAMP],
+                        "interval": "{0}s".format(interval),
+                        "min_doc_count": 1,
+                    }
                 }
             }
         }
+        res = esclient.search(index=config[KEY_CONFIG_INDEX],
+                              doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                              body=probe)
+        buckets = res["aggregations"]["hits"]["buckets"]
+        total = sum(bucket["doc_count"] for bucket in buckets)
+
+        bounds = [earliest]
+        seen = 0
+        for bucket in buckets:
+            seen += bucket["doc_count"]
+            if len(bounds) < windows and seen * windows >= total * len(bounds):
+                bound = int(bucket["key"] // 1000) + interval
+                if bounds[-1] < bound < latest:
+                    bounds.append(bound)
+        bounds.append(latest)
+
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _plan(self, esclient, config, body):
+        """Choose the search mode from a pre-flight count of the matching hits,
+        returns the number of hits expected"""
+
+        res = esclient.count(index=config[KEY_CONFIG_INDEX],
+                             doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                             body={"query": body["query"]})
+        expected = min(res["count"], config[KEY_CONFIG_LIMIT])
+        search_hits = config.get(KEY_CONFIG_PLAN_SEARCH_HITS, DEFAULT_PLAN_SEARCH_HITS)
+        parallel_hits = config.get(KEY_CONFIG_PLAN_PARALLEL_HITS, DEFAULT_PLAN_PARALLEL_HITS)
+        max_slices = config.get(KEY_CONFIG_PLAN_MAX_SLICES, DEFAULT_PLAN_MAX_SLICES)
+
+        # A single search can't go past the result window whatever the threshold
+        if expected <= min(search_hits, PLAN_MAX_SEARCH_HITS):
+            config[KEY_CONFIG_MODE] = MODE_SEARCH
+        else:
+            config[KEY_CONFIG_MODE] = MODE_SCAN
+            if expected > parallel_hits and config[KEY_CONFIG_SLICES] == 1:
+                config[KEY_CONFIG_SLICES] = max(2, min(res["_shards"]["total"], max_slices))
+
+        # Estimated cost in round trips to the cluster
+        if config[KEY_CONFIG_MODE] == MODE_SEARCH:
+            requests = 1
+        else:
+            pages = -(-expected // config[KEY_CONFIG_PAGE_SIZE])
+            requests = pages + config[KEY_CONFIG_SLICES]
+
+        self.write_info("ess plan: mode={0} slices={1} prefetch={2} matching_hits={3} "
+                        "expected_hits={4} estimated_requests={5}".format(
+                            config[KEY_CONFIG_MODE], config[KEY_CONFIG_SLICES],
+                            config[KEY_CONFIG_PREFETCH], res["count"], expected, requests))
+        return expected
+
+    def _search(self, esclient, config):
+        """Search Generate events to Splunk from a Elasticsearch search"""
+
+        # Search body
+        self._project(esclient, config)
+        self._decode_plans(esclient, config)
+        body = self._search_body(config, config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST],
+                                 config[KEY_CONFIG_INCLUDE_LATEST])
+
+        # A planned search asks for the expected hits, not the whole limit
+        # which may exceed the result window
+        size = config[KEY_CONFIG_LIMIT]
+        if config[KEY_CONFIG_MODE] == MODE_AUTO:
+            size = self._plan(esclient, config, body)
+
+        # Scrolls return hits in no particular order, index order is the cheapest
+        if config[KEY_CONFIG_MODE] == MODE_SCAN:
+            body["sort"] = ["_doc"]
 
         # Execute search
-        if config[KEY_CONFIG_SCAN]:
-            res = helpers.scan(esclient,
-                               size=config[KEY_CONFIG_LIMIT],
-                               index=config[KEY_CONFIG_INDEX],
-                               _source_include=config[KEY_CONFIG_FIELDS],
-                               doc_type=config[KEY_CONFIG_SOURCE_TYPE],
-                               query=body)
-            for hit in res:
-                yield self._parse_hit(config, hit)
+        if config[KEY_CONFIG_WINDOWS] > 1 and config[KEY_CONFIG_MODE] != MODE_SEARCH:
+            # Time ordered windows fetched concurrently, each paged with search_after
+            queries = []
+            for earliest, latest in self._time_windows(esclient, config, body):
+                window = self._search_body(config, earliest, latest,
+                                           latest == config[KEY_CONFIG_LATEST] and
+                                           config[KEY_CONFIG_INCLUDE_LATEST])
+                window["sort"].append({"_id": {"order": "asc"}})
+                queries.append(window)
+            hits = helpers.ordered_search_after_scan(esclient, queries,
+                                                     size=config[KEY_CONFIG_PAGE_SIZE],
+                                                     prefetch=config[KEY_CONFIG_PREFETCH],
+                                                     index=config[KEY_CONFIG_INDEX],
+                                                     _source_include=config[KEY_CONFIG_FIELDS],
+                                                     doc_type=config[KEY_CONFIG_SOURCE_TYPE])
+        elif config[KEY_CONFIG_MODE] == MODE_SCAN and config[KEY_CONFIG_SHARDS]:
+            hits = helpers.shard_scan(esclient,
+                                      size=config[KEY_CONFIG_PAGE_SIZE],
+                                      prefetch=config[KEY_CONFIG_PREFETCH],
+                                      stream=config[KEY_CONFIG_STREAM],
+                                      index=config[KEY_CONFIG_INDEX],
+                                      _source_include=config[KEY_CONFIG_FIELDS],
+                                      doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                      query=body)
+        elif config[KEY_CONFIG_MODE] == MODE_SCAN:
+            hits = helpers.sliced_scan(esclient,
+                                       slices=config[KEY_CONFIG_SLICES],
+                                       size=config[KEY_CONFIG_PAGE_SIZE],
+                                       prefetch=config[KEY_CONFIG_PREFETCH],
+                                       stream=config[KEY_CONFIG_STREAM],
+                                       index=config[KEY_CONFIG_INDEX],
+                                       _source_include=config[KEY_CONFIG_FIELDS],
+                                       doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                       query=body)
+        elif config[KEY_CONFIG_MODE] == MODE_SEARCH_AFTER:
+            # _id breaks ties between hits sharing a timestamp
+            body["sort"].append({"_id": {"order": "asc"}})
+            hits = helpers.search_after_scan(esclient,
+                                             size=config[KEY_CONFIG_PAGE_SIZE],
+                                             prefetch=config[KEY_CONFIG_PREFETCH],
+                                             index=config[KEY_CONFIG_INDEX],
+                                             _source_include=config[KEY_CONFIG_FIELDS],
+                                             doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                             query=body)
         else:
             res = esclient.search(index=config[KEY_CONFIG_INDEX],
-                                  size=config[KEY_CONFIG_LIMIT],
+                                  size=size,
                                   _source_include=config[KEY_CONFIG_FIELDS],
                                   doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                  stream=config[KEY_CONFIG_STREAM],
                                   body=body)
-            for hit in res['hits']['hits']:
+            hits = res if config[KEY_CONFIG_STREAM] else res['hits']['hits']
+
+        # limit caps the total number of hits in every mode, stop fetching
+        # (and clear any scroll) as soon as it is reached
+        count = 0
+        try:
+            for hit in hits:
                 yield self._parse_hit(config, hit)
+                count += 1
+                if count >= config[KEY_CONFIG_LIMIT]:
+                    break
+        finally:
+            if hasattr(hits, "close"):
+                hits.close()
 
-    def generate(self):
-        """Generate events to Splunk"""
+    def _stats_metrics(self, config):
+        """Build the metric aggregations for action=stats"""
 
-        # Get config
-        config = self._get_search_config()
+        aggs = {}
+        for i, (_, function, field) in enumerate(config[KEY_CONFIG_STATS]):
+            # A plain count is the bucket doc_count
+            if field:
+                aggs["m{0}".format(i)] = {STATS_FUNCTIONS[function]: {"field": field}}
+        return aggs
+
+    def _stats_aggs(self, config):
+        """Build the nested terms/metric aggregations for action=stats"""
 
-        # Create Elasticsearch client
-        esclient = Elasticsearch(
-            config[KEY_CONFIG_EADDR],
-            verify_certs=config[KEY_CONFIG_VERIFY_CERTS],
-            use_ssl=config[KEY_CONFIG_USE_SSL])
+        aggs = self._stats_metrics(config)
+        for depth in reversed(range(len(config[KEY_CONFIG_BY]))):
+            group = {"terms": {"field": config[KEY_CONFIG_BY][depth],
+                               "size": config[KEY_CONFIG_BUCKETS]}}
+            if aggs:
+                group["aggs"] = aggs
+            aggs = {"by{0}".format(depth): group}
 
+        return aggs
+
+    def _stats_rows(self, config, bucket, row, depth=0):
+        """Generate one row per leaf bucket of the stats aggregations"""
+
+        if depth < len(config[KEY_CONFIG_BY]):
+            for inner in bucket["by{0}".format(depth)]["buckets"]:
+                inrow = dict(row)
+                inrow[config[KEY_CONFIG_BY][depth]] = inner.get("key_as_string", inner["key"])
+                for result in self._stats_rows(config, inner, inrow, depth + 1):
+                    yield result
+            return
+
+        row = dict(row)
+        for i, (name, _, field) in enumerate(config[KEY_CONFIG_STATS]):
+            if field:
+                row[name] = bucket["m{0}".format(i)]["value"]
+            else:
+                row[name] = bucket["doc_count"]
+        yield row
+
+    def _composite_stats(self, esclient, config):
+        """Stream action=stats rows from paged composite aggregations"""
+
+        sources = [{"by{0}".format(i): {"terms": {"field": field}}}
+                   for i, field in enumerate(config[KEY_CONFIG_BY])]
+        metrics = self._stats_metrics(config)
+        query = {"query": self._search_body(config, config[KEY_CONFIG_EARLIEST],
+                                            config[KEY_CONFIG_LATEST])["query"]}
+        buckets = helpers.composite_scan(esclient, query, sources, metrics,
+                                         size=config[KEY_CONFIG_PAGE_SIZE],
+                                         prefetch=config[KEY_CONFIG_PREFETCH],
+                                         index=config[KEY_CONFIG_INDEX],
+                                         doc_type=config[KEY_CONFIG_SOURCE_TYPE])
+        for bucket in buckets:
+            row = {}
+            for i, field in enumerate(config[KEY_CONFIG_BY]):
+                row[field] = bucket["key"]["by{0}".format(i)]
+            for result in self._stats_rows(config, bucket, row, len(config[KEY_CONFIG_BY])):
+                yield result
+
+    def _stats(self, esclient, config):
+        """Generate rows to Splunk from Elasticsearch aggregations"""
+
+        if config[KEY_CONFIG_COMPOSITE] and config[KEY_CONFIG_BY]:
+            # Groups span the whole time range, per window rows would repeat
+            # them and distinct counts can't be merged across windows
+            if config[KEY_CONFIG_WINDOWS] > 1:
+                raise ValueError("windows can't be combined with composite=true")
+            return self._composite_stats(esclient, config)
+
+        body = self._search_body(config, config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST])
+        body = {
+            "size": 0,
+            "query": body["query"],
+        }
+        aggs = self._stats_aggs(config)
+        if aggs:
+            body["aggs"] = aggs
+
+        res = esclient.search(index=config[KEY_CONFIG_INDEX],
+                              doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                              body=body)
+
+        # The top level bucket is the whole result
+        result = res.get("aggregations", {})
+        result["doc_count"] = res["hits"]["total"]
+        return self._stats_rows(config, result, {})
+
+    def _timechart_span(self, config):
+        """Bucket span in seconds from the span option or the search time range"""
+
+        if self.span:
+            match = re.search(r"^(\d+)([a-zA-Z])$", self.span)
+            if not match or match.group(2) not in UNITS:
+                raise ValueError("Invalid span: {0}".format(self.span))
+            multi, unit = match.groups()
+            return int(multi) * UNITS[unit]
+
+        span = (config[KEY_CONFIG_LATEST] - config[KEY_CONFIG_EARLIEST]) / float(self.bins)
+        for candidate in TIMECHART_SPANS:
+            if candidate >= span:
+                return candidate
+        return TIMECHART_SPANS[-1]
+
+    def _timechart(self, esclient, config):
+        """Generate one row per time bucket from a date_histogram aggregation"""
+
+        body = self._search_body(config, config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST])
+        histogram = {
+            "date_histogram": {
+                "field": config[KEY_CONFIG_TIMESTAMP],
+                "interval": "{0}s".format(config[KEY_CONFIG_SPAN]),
+                "min_doc_count": 0,
+                "extended_bounds": {
+                    "min": config[KEY_CONFIG_EARLIEST] * 1000,
+                    "max": config[KEY_CONFIG_LATEST] * 1000,
+                },
+            }
+        }
+        aggs = self._stats_aggs(config)
+        if aggs:
+            histogram["aggs"] = aggs
+        body = {
+            "size": 0,
+            "query": body["query"],
+            "aggs": {"time": histogram},
+        }
+
+        res = esclient.search(index=config[KEY_CONFIG_INDEX],
+                              doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                              body=body)
+        for bucket in res["aggregations"]["time"]["buckets"]:
+            row = {KEY_SPLUNK_TIMESTAMP: int(bucket["key"] // 1000)}
+            for result in self._stats_rows(config, bucket, row):
+                yield result
+
+    def _prune_indices(self, esclient, config):
+        """Resolve the index expression to the concrete date suffixed indices
+        overlapping the search time range, returns None when not applicable
+        or when the expression is best kept as is"""
+
+        date_format = config.get(KEY_CONFIG_INDEX_DATE_FORMAT)
+        if not date_format or not config[KEY_CONFIG_INDEX] or "*" not in config[KEY_CONFIG_INDEX]:
+            return None
+
+        # Suffix pattern and granularity from the strftime like format
+        pattern = re.escape(date_format)
+        unit = "y"
+        for directive in ("%Y", "%m", "%d", "%H"):
+            if directive in date_format:
+                regex, unit = INDEX_DATE_DIRECTIVES[directive]
+                pattern = pattern.replace(re.escape(directive), regex)
+        pattern = re.compile("({0})$".format(pattern))
+
+        try:
+            indices = esclient.cat.indices(index=config[KEY_CONFIG_INDEX], h="index,status",
+                                           format="json")
+        except NotFoundError:
+            return None
+
+        # Closed indices are skipped by wildcards but fail searches naming them
+        names = sorted(index["index"] for index in indices if index.get("status", "open") == "open")
+        result = []
+        for name in names:
+            match = pattern.search(name)
+            if not match:
+                # Not date suffixed, can't tell so keep it
+                result.append(name)
+                continue
+            start = time.strptime(match.group(1), date_format)
+            if unit == "y":
+                end = (start.tm_year + 1, 1, 1, 0, 0, 0)
+            elif unit == "M":
+                end = (start.tm_year + start.tm_mon // 12, start.tm_mon % 12 + 1, 1, 0, 0, 0)
+            else:
+                end = None
+            start = calendar.timegm(start)
+            end = calendar.timegm(end) if end else start + UNITS[unit]
+            if start <= config[KEY_CONFIG_LATEST] and end > config[KEY_CONFIG_EARLIEST]:
+                result.append(name)
+
+        # Nothing pruned, or a list too long for the request line
+        if len(result) == len(names) or len(",".join(result)) > INDEX_PRUNE_MAX_LENGTH:
+            return None
+        return result
+
+    def _search_incremental(self, esclient, config, fingerprint_config):
+        """Search stitching immutable time buckets from the bucket cache with
+        the buckets that are missing or still settling fetched from Elasticsearch"""
+
+        cache = DiskCache(DEFAULT_CACHE_BUCKETS_PATH,
+                          config.get(KEY_CONFIG_CACHE_BUCKET_TTL, DEFAULT_CACHE_BUCKET_TTL),
+                          config.get(KEY_CONFIG_CACHE_MAX_BYTES, DEFAULT_CACHE_MAX_BYTES))
+        span = config.get(KEY_CONFIG_CACHE_BUCKET_SPAN, DEFAULT_CACHE_BUCKET_SPAN)
+        max_events = config.get(KEY_CONFIG_CACHE_MAX_EVENTS, DEFAULT_CACHE_MAX_EVENTS)
+        settled = time.time() - config.get(KEY_CONFIG_CACHE_SETTLE, DEFAULT_CACHE_SETTLE)
+        earliest = config[KEY_CONFIG_EARLIEST]
+        latest = config[KEY_CONFIG_LATEST]
+
+        # Resolve the mappings once for all the segments
+        config = dict(config)
+        self._project(esclient, config)
+        self._decode_plans(esclient, config)
+
+        # Partial head, aligned buckets and partial tail, in time order
+        first = -(-earliest // span) * span
+        last = latest // span * span
+        segments = []
+        if first < last:
+            if earliest < first:
+                segments.append((earliest, first, False, False))
+            for start in range(first, last, span):
+                segments.append((start, start + span, False, start + span <= settled))
+            segments.append((last, latest, True, False))
+        else:
+            segments.append((earliest, latest, True, False))
+
+        def _fetch(start, end, include_end, limit):
+            segment = dict(config)
+            segment[KEY_CONFIG_EARLIEST] = start
+            segment[KEY_CONFIG_LATEST] = end
+            segment[KEY_CONFIG_INCLUDE_LATEST] = include_end
+            segment[KEY_CONFIG_LIMIT] = limit
+            segment[KEY_CONFIG_PAGE_SIZE] = min(config[KEY_CONFIG_PAGE_SIZE], limit)
+            segment[KEY_CONFIG_MODE] = MODE_SEARCH_AFTER
+            segment[KEY_CONFIG_WINDOWS] = 1
+            return self._search(esclient, segment)
+
+        hits = misses = 0
+        count = 0
+        for start, end, include_end, immutable in segments:
+            if not immutable:
+                events = _fetch(start, end, include_end, config[KEY_CONFIG_LIMIT] - count)
+            else:
+                # Bucket contents don't depend on the limit of the search
+                bucket = dict(fingerprint_config)
+                bucket.pop(KEY_CONFIG_LIMIT, None)
+                bucket[KEY_CONFIG_EARLIEST] = start
+                bucket[KEY_CONFIG_LATEST] = end
+                key = _fingerprint("bucket", bucket)
+                events = cache.get(key)
+                if events is not None:
+                    hits += 1
+                else:
+                    misses += 1
+                    # Fetch one more than cacheable to detect oversized buckets
+                    events = list(_fetch(start, end, False, max_events + 1))
+                    remaining = config[KEY_CONFIG_LIMIT] - count
+                    if len(events) <= max_events:
+                        self._cache_set(cache, key, events)
+                    elif remaining > len(events):
+                        # Truncated, fetch the whole bucket live instead
+                        events = _fetch(start, end, False, remaining)
+
+            try:
+                for event in events:
+                    yield event
+                    count += 1
+                    if count >= config[KEY_CONFIG_LIMIT]:
+                        break
+            finally:
+                if hasattr(events, "close"):
+                    events.close()
+            if count >= config[KEY_CONFIG_LIMIT]:
+                break
+
+        self.write_info("ess cache: buckets hit={0} miss={1} span={2}".format(hits, misses, span))
+
+    def _client_options(self, config):
+        """Connection options of the Elasticsearch clients"""
+
+        options = {
+            "verify_certs": config[KEY_CONFIG_VERIFY_CERTS],
+            "use_ssl": config[KEY_CONFIG_USE_SSL],
+            "http_compress": config.get(KEY_CONFIG_HTTP_COMPRESS, DEFAULT_HTTP_COMPRESS),
+            "http_compress_min_bytes": config.get(KEY_CONFIG_HTTP_COMPRESS_MIN_BYTES,
+                                                  DEFAULT_HTTP_COMPRESS_MIN_BYTES),
+            "selector_class": config.get(KEY_CONFIG_SELECTOR, DEFAULT_SELECTOR),
+            "hedge_percentile": config.get(KEY_CONFIG_HEDGE_PERCENTILE, DEFAULT_HEDGE_PERCENTILE),
+            "hedge_budget": config.get(KEY_CONFIG_HEDGE_BUDGET, DEFAULT_HEDGE_BUDGET),
+            "health_check": config.get(KEY_CONFIG_HEALTH_CHECK, DEFAULT_HEALTH_CHECK),
+        }
+
+        # Sniffed and dead nodes and the latencies hedging is based on are
+        # shared by the searches of the same cluster
+        key = hashlib.sha1(json.dumps(config[KEY_CONFIG_EADDR], sort_keys=True).encode("utf-8")).hexdigest()
+        if config.get(KEY_CONFIG_SNIFF, DEFAULT_SNIFF):
+            options["sniff_state_path"] = os.path.join(DEFAULT_SNIFF_PATH, key + ".json")
+            options["sniff_state_ttl"] = config.get(KEY_CONFIG_SNIFF_TTL, DEFAULT_SNIFF_TTL)
+        if options["hedge_percentile"]:
+            options["hedge_state_path"] = os.path.join(DEFAULT_HEDGE_PATH, key + ".json")
+        if config.get(KEY_CONFIG_SHARE_DEAD_NODES, DEFAULT_SHARE_DEAD_NODES):
+            options["dead_state_path"] = os.path.join(DEFAULT_DEAD_NODES_PATH, key + ".json")
+
+        return options
+
+    def _run_action(self, config):
+        """Run the requested action against Elasticsearch"""
+
+        # Create Elasticsearch client, through the local broker when enabled
+        options = self._client_options(config)
+        if config.get(KEY_CONFIG_BROKER, DEFAULT_BROKER):
+            # Imported on use, the broker is only available on Unix
+            from essbroker import BrokerTransport, DEFAULT_BROKER_IDLE_TIMEOUT
+            options["transport_class"] = BrokerTransport
+            options["broker_socket"] = config.get(KEY_CONFIG_BROKER_SOCKET, DEFAULT_BROKER_SOCKET)
+            options["broker_idle_timeout"] = config.get(KEY_CONFIG_BROKER_IDLE_TIMEOUT,
+                                                        DEFAULT_BROKER_IDLE_TIMEOUT)
+
+        esclient = Elasticsearch(config[KEY_CONFIG_EADDR], **options)
+
+        # Cache keys use the index expression, not the indices it resolves to
+        fingerprint_config = dict(config)
+
+        if self.action in (ACTION_SEARCH, ACTION_STATS, ACTION_TIMECHART):
+            indices = self._prune_indices(esclient, config)
+            if indices is not None:
+                if not indices:
+                    return iter(())
+                config[KEY_CONFIG_INDEX] = ",".join(indices)
+
+        if self.action == ACTION_SEARCH and config[KEY_CONFIG_CACHE] == CACHE_INCREMENTAL:
+            return self._search_incremental(esclient, config, fingerprint_config)
         if self.action == ACTION_SEARCH:
             return self._search(esclient, config)
+        if self.action == ACTION_STATS:
+            return self._stats(esclient, config)
+        if self.action == ACTION_TIMECHART:
+            return self._timechart(esclient, config)
         if self.action == ACTION_INDICES_LIST:
             return self._list_indices(esclient)
         if self.action == ACTION_CLUSTER_HEALTH:
             return self._cluster_health(esclient)
 
+    def _cache_results(self, cache, key, config, results):
+        """Pass results through, storing them in the cache once complete"""
+
+        events = []
+        for event in results:
+            if events is not None:
+                events.append(event)
+                if len(events) > config.get(KEY_CONFIG_CACHE_MAX_EVENTS, DEFAULT_CACHE_MAX_EVENTS):
+                    # Too large to be worth caching
+                    events = None
+            yield event
+
+        if events is not None:
+            self._cache_set(cache, key, events)
+
+    def generate(self):
+        """Generate events to Splunk"""
+
+        # Get config
+        config = self._get_search_config()
+
+        if config[KEY_CONFIG_CACHE] == CACHE_RESULTS and \
+                self.action in (ACTION_SEARCH, ACTION_STATS, ACTION_TIMECHART):
+            ttl = config.get(KEY_CONFIG_CACHE_TTL, DEFAULT_CACHE_TTL)
+            cache = DiskCache(DEFAULT_CACHE_PATH, ttl,
+                              config.get(KEY_CONFIG_CACHE_MAX_BYTES, DEFAULT_CACHE_MAX_BYTES))
+            # Ranges ending now move every second, match them to the ttl
+            # granularity so repeated runs within it share the key
+            key_config = dict(config)
+            if ttl > 0 and self._ends_now():
+                for bound in (KEY_CONFIG_EARLIEST, KEY_CONFIG_LATEST):
+                    key_config[bound] = config[bound] - config[bound] % ttl
+            key = _fingerprint(self.action, key_config)
+            events = cache.get(key)
+            if events is not None:
+                self.write_info("ess cache: hit key={0} events={1}".format(key, len(events)))
+                return iter(events)
+            self.write_info("ess cache: miss key={0}".format(key))
+            return self._cache_results(cache, key, config, self._run_action(config))
+
+        return self._run_action(config)
+
+def _fingerprint(action, config):
+    """Normalized fingerprint of everything determining the results of an action"""
+
+    query = dict((key, value) for key, value in config.items() if key not in KEYS_CONFIG_EXECUTION)
+    query["action"] = action
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _parse_stats(stats):
+    """Parse stats functions as (name, function, field) eg. avg(bytes)"""
+
+    result = []
+    for name in stats.split(","):
+        name = name.strip()
+        match = re.search(r"^(\w+)(?:\(([^)]+)\))?$", name)
+        if not match or match.group(1) not in STATS_FUNCTIONS:
+            raise ValueError("Unsupported stats function: {0}".format(name))
+        function, field = match.groups()
+        if function != "count" and not field:
+            raise ValueError("Stats function requires a field: {0}".format(name))
+        result.append((name, function, field))
+    return result
+
+def _to_epoch(value, scale=1000.0):
+    """Convert a date field value to epoch seconds, unknown formats are kept.
+    Numeric dates are divided by scale, epoch milliseconds by default"""
+
+    if isinstance(value, numbers.Number):
+        return value / scale
+    match = RE_ISO_TIMESTAMP.search(value) if isinstance(value, string_types) else None
+    if not match:
+        return value
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    epoch = calendar.timegm((int(year), int(month), int(day), int(hour or 0),
+                             int(minute or 0), int(second or 0)))
+    if fraction:
+        epoch += float(fraction)
+    if zone and zone != "Z":
+        zone = zone.replace(":", "")
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        epoch += -offset if zone[0] == "+" else offset
+    return epoch
+
+def _timestamp_decoder(date_format=None):
+    """Decoder setting the Splunk timestamp from a date field, numeric dates
+    read in the epoch unit of the mapped format"""
+
+    # The first epoch format of the mapping is the one parsing numbers
+    scale = 1000.0
+    for name in (date_format or "").split("||"):
+        name = name.strip()
+        if name == "epoch_second":
+            scale = 1.0
+            break
+        if name == "epoch_millis":
+            break
+
+    def decode(event, value):
+        event[KEY_SPLUNK_TIMESTAMP] = _to_epoch(value, scale)
+    return decode
+
+def _field_mapping(properties, path):
+    """Mapping of a field by its dotted path, None when it isn't mapped"""
+
+    mapping = None
+    for name in path.split("."):
+        mapping = properties.get(name)
+        if mapping is None:
+            return None
+        properties = mapping.get("properties", {})
+    return mapping
+
+def _value_decoder(path, coerce):
+    """Decoder setting a leaf value, coerced to the mapped type. Objects
+    mapped without properties (eg. geo_point, disabled objects) are
+    flattened as with decode=dynamic"""
+
+    if coerce is None:
+        def decode(event, value):
+            if isinstance(value, dict):
+                event.update(_flattern(path, value))
+            else:
+                event[path] = value
+    else:
+        def decode(event, value):
+            if isinstance(value, dict):
+                event.update(_flattern(path, value))
+            elif isinstance(value, list):
+                event[path] = [_coerce(coerce, item) for item in value]
+            else:
+                event[path] = _coerce(coerce, value)
+    return decode
+
+def _coerce(coerce, value):
+    """Coerce a value to the mapped type, keeping the source value when it
+    doesn't convert or would lose information (eg. 1.5 in a long field)"""
+
+    try:
+        result = coerce(value)
+    except (TypeError, ValueError):
+        return value
+    if isinstance(value, numbers.Number) and result != value:
+        return value
+    return result
+
+def _object_decoder(path, plan):
+    """Decoder flattening an object with the plan of its properties"""
+
+    def decode(event, value):
+        if not isinstance(value, dict):
+            # Arrays of objects can't be flattened
+            event[path] = value
+            return
+        for key in value:
+            decoder = plan.get(key)
+            if decoder is not None:
+                decoder(event, value[key])
+            elif isinstance(value[key], dict):
+                event.update(_flattern(path + "." + key, value[key]))
+            else:
+                event[path + "." + key] = value[key]
+    return decode
+
+def _json_decoder(path):
+    """Decoder keeping nested documents as JSON"""
+
+    def decode(event, value):
+        event[path] = json.dumps(value)
+    return decode
+
+def _decode_plan(properties, prefix=""):
+    """Compile mapping properties to a dict of key -> decoder(event, value)"""
+
+    plan = {}
+    for name, mapping in properties.items():
+        path = prefix + name
+        if mapping.get("type") == "nested":
+            plan[name] = _json_decoder(path)
+        elif "properties" in mapping:
+            plan[name] = _object_decoder(path, _decode_plan(mapping["properties"], path + "."))
+        else:
+            plan[name] = _value_decoder(path, COERCE_TYPES.get(mapping.get("type")))
+    return plan
+
 def _flattern(key, data):
     result = {}
     for inkey in data:
@@ -0,0 +1,350 @@
+# ElasticSplunk broker
+# Long lived local process keeping warm Elasticsearch connections for
+# the short lived ess search processes
+#
+# Written by Bruno Moura <brunotm@gmail.com>
+#
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import hashlib
+import threading
+import subprocess
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# Unix sockets and fcntl locks, the broker isn't available without them (eg. Windows)
+try:
+    import fcntl
+    UnixStreamServer = socketserver.UnixStreamServer
+    BROKER_SUPPORTED = True
+except (ImportError, AttributeError):
+    fcntl = None
+    UnixStreamServer = object
+    BROKER_SUPPORTED = False
+
+from elasticsearch import Transport, TransportError, ImproperlyConfigured
+from elasticsearch import exceptions
+from elasticsearch.stream import StreamedResponse
+from elasticsearch.compat import string_types
+from elasticsearch.client.utils import _escape
+
+# Broker defaults, overridable per cluster in elasticsplunk.json
+DEFAULT_BROKER_IDLE_TIMEOUT = 600
+
+# Response kinds
+KIND_VALUE = "value"
+KIND_STREAM = "stream"
+KIND_ERROR = "error"
+
+# Endpoints answered with hits, "scroll" being the last part of _search/scroll
+STREAM_ENDPOINTS = ("_search", "scroll")
+
+
+def _send_frame(wfile, data):
+    """Write a length prefixed frame"""
+
+    wfile.write(("%d\n" % len(data)).encode("ascii"))
+    wfile.write(data)
+
+
+def _recv_frame(rfile):
+    """Read a length prefixed frame, None when the peer went away"""
+
+    size = rfile.readline()
+    if not size:
+        return None
+    size = int(size)
+    data = rfile.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def _send_json(wfile, value):
+    _send_frame(wfile, json.dumps(value).encode("utf-8"))
+    wfile.flush()
+
+
+def _recv_json(rfile):
+    data = _recv_frame(rfile)
+    return None if data is None else json.loads(data.decode("utf-8"))
+
+
+def _text(value):
+    """Params are escaped to bytes by the client, send them as text"""
+
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """Serve one request: a JSON header frame, a body frame when the header
+    says so, answered by a JSON header frame followed, for streamed
+    responses, by the raw body as frames ended by an empty one"""
+
+    def handle(self):
+        self.server.enter()
+        try:
+            request = _recv_json(self.rfile)
+            if request is None:
+                return
+            body = None
+            if request["body"]:
+                body = _recv_frame(self.rfile).decode("utf-8")
+
+            transport = self.server.transport(request["cluster"])
+            params = {}
+            if request.get("stream") or _returns_hits(request["method"], request["url"]):
+                params["stream"] = True
+            for key, value in (request["params"] or {}).items():
+                params[key] = value if key in ("ignore", "request_timeout") else _escape(value)
+            try:
+                response = transport.perform_request(request["method"], request["url"],
+                                                     headers=request["headers"],
+                                                     params=params, body=body)
+            except Exception as e:
+                _send_json(self.wfile, {"kind": KIND_ERROR, "error": _error(e)})
+                return
+
+            if not isinstance(response, StreamedResponse):
+                _send_json(self.wfile, {"kind": KIND_VALUE, "value": response})
+                return
+
+            _send_json(self.wfile, {"kind": KIND_STREAM,
+                                    "content_type": response.headers.get("content-type")})
+            for chunk in response.raw():
+                _send_frame(self.wfile, chunk)
+            _send_frame(self.wfile, b"")
+            self.wfile.flush()
+        except socket.error:
+            # Client went away, the streamed response is closed by raw()
+            pass
+        finally:
+            self.server.leave()
+
+
+def _returns_hits(method, url):
+    """Whether a request may answer with pages of hits, relayed as a stream
+    rather than decoded and encoded again by the broker"""
+
+    return method in ("GET", "POST") and url.rstrip("/").rsplit("/", 1)[-1] in STREAM_ENDPOINTS
+
+
+def _error(error):
+    """Describe an exception so the client can raise it again"""
+
+    if not isinstance(error, TransportError):
+        return {"class": "TransportError", "status": "N/A", "error": str(error), "info": None}
+    info = error.info
+    if not isinstance(info, (dict, list, string_types)) and info is not None:
+        info = str(info)
+    return {"class": error.__class__.__name__, "status": error.status_code,
+            "error": error.error, "info": info}
+
+
+class BrokerServer(socketserver.ThreadingMixIn, UnixStreamServer):
+    """Unix socket server owning one Transport per cluster configuration,
+    exiting once idle"""
+
+    daemon_threads = True
+
+    def __init__(self, path, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.transports = {}
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_used = time.time()
+        UnixStreamServer.__init__(self, path, BrokerHandler)
+
+    def transport(self, cluster):
+        """Return the Transport for a cluster configuration, creating it once"""
+
+        key = hashlib.sha1(json.dumps(cluster, sort_keys=True).encode("utf-8")).hexdigest()
+        with self.lock:
+            if key not in self.transports:
+                self.transports[key] = Transport(cluster["hosts"], **cluster["kwargs"])
+            return self.transports[key]
+
+    def enter(self):
+        with self.lock:
+            self.active += 1
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+            self.last_used = time.time()
+
+    def idle(self):
+        with self.lock:
+            return not self.active and time.time() - self.last_used > self.idle_timeout
+
+    def close(self):
+        for transport in self.transports.values():
+            transport.close()
+        self.server_close()
+
+
+def serve(path, idle_timeout=DEFAULT_BROKER_IDLE_TIMEOUT):
+    """Run the broker on path until idle for idle_timeout seconds"""
+
+    # A single broker per socket, held for its whole life
+    lock = open(path + ".lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return
+
+    # Only the Splunk user may talk to the broker
+    os.umask(0o077)
+    if os.path.exists(path):
+        os.remove(path)
+    server = BrokerServer(path, idle_timeout)
+
+    def _watch():
+        while not server.idle():
+            time.sleep(min(idle_timeout, 5))
+        server.shutdown()
+
+    watcher = threading.Thread(target=_watch)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(path)
+        server.close()
+        lock.close()
+
+
+def spawn(path, idle_timeout=DEFAULT_BROKER_IDLE_TIMEOUT):
+    """Start a detached broker on path, returns without waiting for it"""
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by a concurrent search
+            pass
+
+    with open(os.devnull, "r+b") as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), path, str(idle_timeout)],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+class BrokerTransport(Transport):
+    """Transport handing requests to a local broker and reading the responses
+    back from it, falling back to connecting directly while no broker is
+    running. Streamed responses are passed through as read by the broker"""
+
+    def __init__(self, hosts, broker_socket=None, broker_spawn=True,
+                 broker_idle_timeout=DEFAULT_BROKER_IDLE_TIMEOUT, **kwargs):
+        if not BROKER_SUPPORTED:
+            raise ImproperlyConfigured("The broker needs Unix sockets, not available on this platform")
+        super(BrokerTransport, self).__init__(hosts, **kwargs)
+        self.broker_socket = broker_socket
+        self.broker_spawn = broker_spawn
+        self.broker_idle_timeout = broker_idle_timeout
+        self.cluster = {"hosts": hosts, "kwargs": kwargs}
+        try:
+            json.dumps(self.cluster)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Broker transport options must be JSON serializable")
+
+    def _connect(self):
+        """Connect to the broker, None when it isn't running"""
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.broker_socket)
+            return sock
+        except socket.error as e:
+            sock.close()
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            if self.broker_spawn:
+                # Spawn once per process, the requests of this one go direct
+                self.broker_spawn = False
+                spawn(self.broker_socket, self.broker_idle_timeout)
+            return None
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        sock = self._connect()
+        if sock is None:
+            return super(BrokerTransport, self).perform_request(method, url, headers=headers,
+                                                                params=params, body=body)
+
+        params = dict(params or {})
+        stream = params.pop("stream", False)
+        if body is not None:
+            body = self.serializer.dumps(body)
+            if not isinstance(body, bytes):
+                body = body.encode("utf-8")
+
+        try:
+            rfile = sock.makefile("rb")
+            wfile = sock.makefile("wb")
+            _send_frame(wfile, json.dumps({
+                "cluster": self.cluster, "method": method, "url": url, "headers": headers,
+                "params": dict((key, _text(value)) for key, value in params.items()),
+                "body": body is not None, "stream": bool(stream)}).encode("utf-8"))
+            if body is not None:
+                _send_frame(wfile, body)
+            wfile.flush()
+            response = _recv_json(rfile)
+        except socket.error as e:
+            sock.close()
+            raise exceptions.ConnectionError("N/A", str(e), e)
+        if response is None:
+            sock.close()
+            raise exceptions.ConnectionError("N/A", "Broker closed the connection", None)
+
+        if response["kind"] == KIND_ERROR:
+            sock.close()
+            error = response["error"]
+            error_class = getattr(exceptions, error["class"], TransportError)
+            if not isinstance(error_class, type) or not issubclass(error_class, TransportError):
+                error_class = TransportError
+            raise error_class(error["status"], error["error"], error["info"])
+
+        if response["kind"] == KIND_VALUE:
+            sock.close()
+            return response["value"]
+
+        chunks = self._read_chunks(sock, rfile)
+        if stream:
+            return StreamedResponse(chunks, lambda done: sock.close(),
+                                    {"content-type": response["content_type"]})
+        data = b"".join(chunks).decode("utf-8")
+        if data:
+            data = self.deserializer.loads(data, response["content_type"])
+        return data
+
+    def _read_chunks(self, sock, rfile):
+        try:
+            while True:
+                try:
+                    chunk = _recv_frame(rfile)
+                except socket.error as e:
+                    raise exceptions.ConnectionError("N/A", str(e), e)
+                if chunk is None:
+                    raise exceptions.ConnectionError("N/A", "Broker closed the connection", None)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            sock.close()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BROKER_IDLE_TIMEOUT)